@@ -5,22 +5,50 @@
 
 # Usage: java HackAssembler xxx.asm
 # This command should create (or override) an xxx.hack file that can be executed as-is on the Hack computer
+# Usage: python HackAssembler.py xxx.asm --binary
+# writes xxx.hackbin instead: the program as packed little-endian uint16 words, 2 bytes per instruction
+# --stats prints a JSON dump of the counters and per-phase timings, --verbose logs every line
+# --map also writes xxx.hackmap, the source map from ROM address to .asm line
+# --optimize threads jump chains, removes jumps to the next instruction and unreachable
+# code and drops unused labels before encoding (see optimize()); xxx.hackmap then also
+# holds "addresses", the new ROM address of every unoptimized one (null where removed)
+
+# Library use: assemble(source) takes the program as a str, bytes or iterable of lines and
+# returns the list of instruction words without touching disk; hack_text(words) and
+# hackbin_bytes(words) encode them. HackAssembler(f_name) is the file-to-file driver.
 
 # Staged development
 # Develop a basic assembler that translates assembly programs without symbols
 # Develop an ability to handle symbols
 # Morph the basic assembler into an assembler that can translate any assembly program
 
+import json
+import logging
+import mmap
+import os
 import sys
+import time
+from array import array
+from collections import namedtuple
 debug = False
+log = logging.getLogger('HackAssembler')
+
+# one parsed assembly command; line is the 1-based line number in the .asm source
+Instruction = namedtuple('Instruction', 'commandType symbol dest comp jump line')
 
 
 class Parser:
     def __init__(self, infile):
-        # Constructor for a Parser object that accepts a string specifying a file name
-        # Need to know how to read text files
-        # start reading a file with a given name
-        self.file = infile
+        # Constructor for a Parser object that accepts an open file, the source text
+        # (str or bytes) or any iterable of lines
+        # The source is read once into memory; both passes then run over the tokenized
+        # instruction list instead of re-reading the file
+        if hasattr(infile, 'read'):
+            infile = infile.read()
+        if isinstance(infile, bytes):
+            infile = infile.decode()
+        self.lines = infile.splitlines() if isinstance(infile, str) else list(infile)
+        self.line_no = 0
         self.commandType = None
         self.symbol = None
         self.jump = None
@@ -28,29 +56,33 @@ class Parser:
         self.comp = None
 
     def has_more_commands(self):
-        cur_pos = self.file.tell()
-        has_line = bool(self.file.readline())
-        self.file.seek(cur_pos)
-        return has_line
+        return self.line_no < len(self.lines)
 
     def advance(self):
-        line = self.file.readline().rstrip()
+        self.line_no += 1
+        self.parse(self.lines[self.line_no - 1])
+        if debug:
+            log.debug('%s', self.instruction())
+
+    def parse(self, line):
+        # split one line of assembly into the command fields
+        line = line.rstrip()
         self.commandType = None
         self.symbol = None
         self.jump = None
         self.dest = None
         self.comp = None
         if debug:
-            print('line before: ', line)
+            log.debug('line before: %s', line)
         # comments > text beginning with two slashes (//) and ending at the end of the line is considered a comment and is ignored
         line = line.split('//')[0]
         # white space > space characters are ignored. empty lines are ignored.
         line = "".join(line.split())
         # move to the next command in file
         if debug:
-            print('line after: ', line)
+            log.debug('line after: %s', line)
         if not line:
-            print('line empty')
+            pass
         elif line[0] == '@':
             # print('A instruction')
             self.commandType = 'A_COMMAND'
@@ -86,7 +118,19 @@ class Parser:
                 self.comp = l_split[1]
             else:
                 self.comp = l_split[0]
-        print(self.__dict__)
+
+    def instruction(self):
+        # compact record of the current command, tagged with its (1-based) source line
+        return Instruction(self.commandType, self.symbol, self.dest, self.comp, self.jump, self.line_no)
+
+    def tokenize(self):
+        # tokenize the remaining source into a list of Instruction records, skipping empty lines
+        instructions = []
+        while self.has_more_commands():
+            self.advance()
+            if self.commandType:
+                instructions.append(self.instruction())
+        return instructions
 
 
 class Code:
@@ -118,7 +162,7 @@ class Code:
         'A':    '0110000',
         '!D':   '0001101',
         '!A':   '0110001',
-        '-D':   '0001101',
+        '-D':   '0001111',
         '-A':   '0110011',
         'D+1':  '0011111',
         'A+1':  '0110111',
@@ -138,8 +182,17 @@ class Code:
         'D-M':  '1010011',
         'M-D':  '1000111',
         'D&M':  '1000000',
-        'D|M':  '1010101'
+        'D|M':  '1010101',
+        # commutative spellings accepted by the reference assembler
+        'A+D':  '0000010',
+        'A&D':  '0000000',
+        'A|D':  '0010101',
+        'M+D':  '1000010',
+        'M&D':  '1000000',
+        'M|D':  '1010101'
     }
+    # (comp, dest, jump) -> complete 16-bit C-instruction word, filled in by build_words()
+    d_word = {}
 
     @classmethod
     def dest(cls, d):
@@ -153,38 +206,98 @@ class Code:
     def jump(cls, j):
         return cls.d_jump[j]
 
+    @classmethod
+    def build_words(cls):
+        # precompute every comp x dest x jump combination as an int so that encoding
+        # a C-instruction is a single dictionary lookup with no string building
+        cls.d_word = {
+            (c, d, j): 0xE000 | int(cb, 2) << 6 | int(db, 2) << 3 | int(jb, 2)
+            for c, cb in cls.d_comp.items()
+            for d, db in cls.d_dest.items()
+            for j, jb in cls.d_jump.items()
+        }
+        return cls.d_word
+
+    @classmethod
+    def word(cls, c, d=None, j=None):
+        return cls.d_word[(c, d, j)]
+
+    @staticmethod
+    def alu(bits, x, y):
+        # run the Hack ALU for the 6 control bits (zx nx zy ny f no) on 16-bit x and y
+        zx, nx, zy, ny, f, no = (bits >> i & 1 for i in range(5, -1, -1))
+        if zx:
+            x = 0
+        if nx:
+            x = ~x
+        if zy:
+            y = 0
+        if ny:
+            y = ~y
+        out = x + y if f else x & y
+        if no:
+            out = ~out
+        return out & 0xFFFF
+
+    @classmethod
+    def check(cls):
+        # compare each comp entry's bits against the ALU on a few sample operands
+        # and return the mnemonics whose encoding does not compute what they say
+        samples = ((0, 0), (1, 2), (7, 5), (-3, 12), (0x7FFF, -0x8000), (-1, 0x1234))
+        bad = []
+        for c, cb in cls.d_comp.items():
+            expr = c.replace('!', '~')
+            for x, y in samples:
+                want = eval(expr, {}, {'D': x, 'A': y, 'M': y}) & 0xFFFF
+                if cls.alu(int(cb[1:], 2), x, y) != want:
+                    bad.append(c)
+                    break
+            # the M variant must be the A variant with only the a-bit set
+            twin = c.replace('M', 'A')
+            if 'M' in c and cls.d_comp.get(twin) != '0' + cb[1:] or 'A' in c and cb[0] != '0':
+                bad.append(c)
+        return bad
+
+
+Code.build_words()
+
 
 class SymbolTable:
     # three types of symbols in the Hack language: predefined
     # symbols, labels, and variables.
+    # all the predefined symbols and their pre-allocated RAM addresses
+    d_predefined = {
+        'SP':   0,
+        'LCL':  1,
+        'ARG':  2,
+        'THIS': 3,
+        'THAT': 4,
+        'R0':   0,
+        'R1':   1,
+        'R2':   2,
+        'R3':   3,
+        'R4':   4,
+        'R5':   5,
+        'R6':   6,
+        'R7':   7,
+        'R8':   8,
+        'R9':   9,
+        'R10':  10,
+        'R11':  11,
+        'R12':  12,
+        'R13':  13,
+        'R14':  14,
+        'R15':  15,
+        'SCREEN':   16384,
+        'KBD':      24576
+    }
+
     def __init__(self):
-        # Initialize the symbol table with all the predefined symbols and their
-        # pre-allocated RAM addresses
-        self.d_symbol = {
-            'SP':   0,
-            'LCL':  1,
-            'ARG':  2,
-            'THIS': 3,
-            'THAT': 4,
-            'R0':   0,
-            'R1':   1,
-            'R2':   2,
-            'R3':   3,
-            'R4':   4,
-            'R5':   5,
-            'R6':   6,
-            'R7':   7,
-            'R8':   8,
-            'R9':   9,
-            'R10':  10,
-            'R11':  11,
-            'R12':  12,
-            'R13':  13,
-            'R14':  14,
-            'R15':  15,
-            'SCREEN':   16384,
-            'KBD':      24576
-        }
+        # Initialize the symbol table with the predefined symbols; a copy of the shared
+        # class-level table, so a long-running process pays no per-program setup
+        self.d_symbol = dict(self.d_predefined)
+        # next free RAM address for variables
+        self.addr_ram = 16
 
     def add_entry(self, sym, addr):
         self.d_symbol[sym] = addr
@@ -195,69 +308,363 @@ class SymbolTable:
     def get_address(self, sym):
         return self.d_symbol[sym]
 
+    def add_variable(self, sym):
+        # allocate the next RAM address to a new variable and return it
+        addr = self.d_symbol[sym] = self.addr_ram
+        self.addr_ram += 1
+        return addr
 
-class HackAssembler:
-    def __init__(self, f_name):
-        # initializes the I/O files and drives the process
-        l_split = f_name.split('.')
-        self.prog_name = l_split[0]
-        self.addr_rom = 0
-        self.addr_ram = 16
-        infile = open(f_name, 'r')
-        parser = Parser(infile)
+
+def hack_text(words):
+    # the .hack text form: one 16-character binary string per line
+    return '\n'.join(map('{:016b}'.format, words)) + '\n' if words else ''
+
+
+def hackbin_bytes(words):
+    # the .hackbin form: little-endian uint16 words
+    buf = array('H', words)
+    if sys.byteorder == 'big':
+        buf.byteswap()
+    return buf.tobytes()
+
+
+def write_hackbin(f_name, words):
+    # write the program as a little-endian uint16 image in one bulk write
+    with open(f_name, 'wb') as outfile:
+        outfile.write(hackbin_bytes(words))
+
+
+def load_hackbin(f_name):
+    # map a .hackbin image read-only and view it as uint16 words without copying or parsing
+    with open(f_name, 'rb') as infile:
+        if sys.byteorder == 'big' or not os.fstat(infile.fileno()).st_size:
+            # empty images cannot be mapped, and big-endian hosts need the bytes swapped
+            buf = array('H')
+            buf.frombytes(infile.read())
+            if sys.byteorder == 'big':
+                buf.byteswap()
+            return memoryview(buf)
+        rom = mmap.mmap(infile.fileno(), 0, access=mmap.ACCESS_READ)
+    return memoryview(rom).cast('H')
+
+
+def assemble_stream(lines):
+    # one-pass assembly of an iterable of lines (e.g. a generator) into a list of words:
+    # forward references are recorded in a backpatch list and filled in at the end,
+    # where symbols never defined as labels become variables in order of first use
+    parser = Parser(())
+    symbol_table = SymbolTable()
+    words = []
+    backpatch = {}
+    for line in lines:
+        parser.parse(line)
+        if parser.commandType == 'C_COMMAND':
+            words.append(Code.d_word[(parser.comp, parser.dest, parser.jump)])
+        elif parser.commandType == 'A_COMMAND':
+            symbol = parser.symbol
+            if symbol[0].isdigit():
+                words.append(int(symbol))
+            elif symbol_table.contains(symbol):
+                words.append(symbol_table.get_address(symbol))
+            else:
+                backpatch.setdefault(symbol, []).append(len(words))
+                words.append(0)
+        elif parser.commandType == 'L_COMMAND':
+            symbol_table.add_entry(parser.symbol, len(words))
+    for symbol, sites in backpatch.items():
+        if symbol_table.contains(symbol):
+            addr = symbol_table.get_address(symbol)
+        else:
+            addr = symbol_table.add_variable(symbol)
+        for site in sites:
+            words[site] = addr
+    return words
+
+
+def first_pass(instructions, symbol_table, counters=None):
+    # bind every label to the ROM address of the instruction that follows it
+    addr_rom = 0
+    for inst in instructions:
+        if counters is not None:
+            counters[inst.commandType] += 1
+        if inst.commandType == 'L_COMMAND':
+            symbol_table.add_entry(inst.symbol, addr_rom)
+        else:
+            addr_rom += 1
+    if debug:
+        log.debug('symbols after first pass: %s', symbol_table.d_symbol)
+    return addr_rom
+
+
+def second_pass(instructions, symbol_table):
+    # encode every A- and C-instruction; symbols not bound by the first pass are variables
+    words = []
+    for inst in instructions:
+        if inst.commandType == 'C_COMMAND':
+            # For each C-instruction, the comp, dest and jump fields map straight to
+            # a precomputed 16-bit word.
+            word = Code.d_word[(inst.comp, inst.dest, inst.jump)]
+        elif inst.commandType == 'A_COMMAND':
+            # For each A-instruction of type @Xxx, the program translates the
+            # decimal constant returned by the parser into its binary representation
+            try:
+                word = int(inst.symbol)
+            except ValueError:
+                if symbol_table.contains(inst.symbol):
+                    word = symbol_table.get_address(inst.symbol)
+                else:
+                    word = symbol_table.add_variable(inst.symbol)
+                    if debug:
+                        log.debug('variable %s at %d', inst.symbol, word)
+        else:
+            continue
+        words.append(word)
+    return words
+
+
+def rom_lines(instructions):
+    # source map: the .asm line of the instruction at every ROM address
+    return [inst.line for inst in instructions if inst.commandType != 'L_COMMAND']
+
+
+def is_direct_jump(inst):
+    # a C-instruction that jumps to the address in A and has no other effect, so the
+    # @symbol before it is only a jump target
+    return (inst.commandType == 'C_COMMAND' and inst.jump is not None and inst.dest is None
+            and 'A' not in inst.comp and 'M' not in inst.comp)
+
+
+def optimize(instructions, symbol_table):
+    # ROM optimizer over the instruction list after pass 1 (symbol_table holds the
+    # labels). Returns the optimized instruction list, a new symbol table for encoding
+    # it with second_pass(), the new ROM address of every old one (None where removed)
+    # and stats; cycles_saved is a static estimate, the cycles saved by executing every
+    # changed jump once.
+    # - label coalescing: references to an address all use the first label declared
+    #   there, and labels nobody refers to are dropped
+    # - jump threading: a jump to '@L, 0;JMP' jumps straight to L
+    # - a jump to the next instruction is removed when that instruction sets A
+    # - unreachable code is removed. Code is reachable from address 0 and from every
+    #   label whose address is taken as data (@L not followed by a jump), which covers
+    #   the targets of indirect jumps such as the VM return sequence
+    # Instructions keep their source lines, so rom_lines() of the result is the source
+    # map of the optimized program, and variables get the RAM addresses they would have
+    # had without it. Any numeric @n inside the ROM may be a jump target, directly or
+    # through RAM, so it is a reachability root and nothing up to address n moves.
+    # ROM addresses computed by arithmetic are not supported.
+    rom = [inst for inst in instructions if inst.commandType != 'L_COMMAND']
+    stats = {'words_saved': 0, 'cycles_saved': 0, 'threaded': 0, 'next_jumps': 0,
+             'unreachable': 0, 'labels_removed': 0}
+    # old address -> the label instruction all references to it will use
+    declared = {}
+    n_labels = 0
+    for inst in instructions:
+        if inst.commandType == 'L_COMMAND':
+            declared.setdefault(symbol_table.get_address(inst.symbol), inst)
+            n_labels += 1
+    label_names = {inst.symbol for inst in instructions if inst.commandType == 'L_COMMAND'}
+    # nodes are [instruction, old address]; a final sentinel holds labels at the end
+    nodes = []
+    # instructions before pinned_end keep their address: it is past every numeric @n in ROM
+    pinned_end = 0
+    for addr, inst in enumerate(rom):
+        if inst.commandType == 'A_COMMAND':
+            if inst.symbol in label_names:
+                inst = inst._replace(symbol=declared[symbol_table.get_address(inst.symbol)].symbol)
+            elif inst.symbol[0].isdigit() and int(inst.symbol) < len(rom):
+                pinned_end = max(pinned_end, int(inst.symbol) + 1)
+        nodes.append([inst, addr])
+    nodes.append([None, len(rom)])
+    # label -> old address, for the labels still in use
+    at = {inst.symbol: addr for addr, inst in declared.items()}
+
+    def is_target(inst):
+        return inst is not None and inst.commandType == 'A_COMMAND' and inst.symbol in at
+
+    for _ in range(len(nodes)):
+        index = {old: i for i, (_, old) in enumerate(nodes)}
+
+        def jump_pair(i):
+            # L when nodes i, i+1 are '@L, jump' and nothing can jump in between them
+            if (is_target(nodes[i][0]) and nodes[i + 1][0] is not None and is_direct_jump(nodes[i + 1][0])
+                    and nodes[i + 1][1] not in declared):
+                return nodes[i][0].symbol
+            return None
+
+        changed = False
+        # jump threading
+        for i in range(len(nodes) - 1):
+            symbol = jump_pair(i)
+            if symbol is None:
+                continue
+            hops = 0
+            final = symbol
+            while hops < len(nodes):
+                t = index.get(at[final])
+                if t is None or t + 1 >= len(nodes) or nodes[t + 1][0] is None or nodes[t + 1][0].jump != 'JMP':
+                    break
+                nxt = jump_pair(t)
+                if nxt is None or nxt == final:
+                    break
+                final = nxt
+                hops += 1
+            if final != symbol:
+                nodes[i][0] = nodes[i][0]._replace(symbol=final)
+                stats['threaded'] += 1
+                stats['cycles_saved'] += 2 * hops
+                changed = True
+        # jumps to the next instruction; the label there stays, one before the pair
+        # is merged into it
+        i = 0
+        while i < len(nodes) - 2:
+            symbol = jump_pair(i)
+            if (symbol is None or at[symbol] != nodes[i + 2][1] or nodes[i + 2][0] is None
+                    or nodes[i + 2][0].commandType != 'A_COMMAND' or nodes[i][1] < pinned_end):
+                i += 1
+                continue
+            merged = declared.pop(nodes[i][1], None)
+            if merged is not None:
+                del at[merged.symbol]
+                for node in nodes:
+                    if node[0] is not None and node[0].commandType == 'A_COMMAND' and node[0].symbol == merged.symbol:
+                        node[0] = node[0]._replace(symbol=symbol)
+            del nodes[i:i + 2]
+            stats['next_jumps'] += 1
+            stats['cycles_saved'] += 2
+            changed = True
+        index = {old: i for i, (_, old) in enumerate(nodes)}
+        # reachability
+        todo = [0]
+        for i, (inst, old) in enumerate(nodes):
+            if is_target(inst) and jump_pair(i) is None and at[inst.symbol] in index:
+                todo.append(index[at[inst.symbol]])
+            if old < pinned_end:
+                todo.append(i)
+        reached = set()
+        while todo:
+            i = todo.pop()
+            inst = nodes[i][0]
+            if i in reached or inst is None:
+                continue
+            reached.add(i)
+            if inst.commandType == 'C_COMMAND' and inst.jump is not None:
+                # an indirect jump goes to an address-taken label, already a root
+                if i > 0 and jump_pair(i - 1) is not None and at[jump_pair(i - 1)] in index:
+                    todo.append(index[at[jump_pair(i - 1)]])
+                if inst.jump != 'JMP':
+                    todo.append(i + 1)
+            else:
+                todo.append(i + 1)
+        if len(reached) < len(nodes) - 1:
+            stats['unreachable'] += len(nodes) - 1 - len(reached)
+            for i, (inst, old) in enumerate(nodes):
+                if i not in reached and inst is not None and old in declared:
+                    del at[declared.pop(old).symbol]
+            nodes = [node for i, node in enumerate(nodes) if i in reached or node[0] is None]
+            changed = True
+        if not changed:
+            break
+    # lay the program out again with the labels still referred to
+    used = {inst.symbol for inst, _ in nodes if inst is not None and inst.commandType == 'A_COMMAND'}
+    result = []
+    addresses = [None] * len(rom)
+    for new, (inst, old) in enumerate(nodes):
+        if old in declared and declared[old].symbol in used:
+            result.append(declared[old])
+        if inst is not None:
+            addresses[old] = new
+            result.append(inst)
+    stats['words_saved'] = len(rom) - (len(nodes) - 1)
+    stats['labels_removed'] = n_labels - sum(inst.commandType == 'L_COMMAND' for inst in result)
+    table = SymbolTable()
+    first_pass(result, table)
+    for inst in instructions:
+        if (inst.commandType == 'A_COMMAND' and not inst.symbol[0].isdigit()
+                and not symbol_table.contains(inst.symbol) and not table.contains(inst.symbol)):
+            table.add_variable(inst.symbol)
+    return result, table, addresses, stats
+
+
+def assemble(source, symbol_table=None, optimize_rom=False):
+    # two-pass assembly of source (str, bytes or an iterable of lines) into a list of
+    # instruction words; no file is opened. symbol_table defaults to a fresh table and
+    # holds the labels and variables afterwards. optimize_rom runs optimize() between
+    # the passes.
+    if symbol_table is None:
         symbol_table = SymbolTable()
-        # first pass
-        while parser.has_more_commands():
-            parser.advance()
-            print('addr_rom: ', self.addr_rom)
-            if parser.commandType == 'C_COMMAND':
-                self.addr_rom += 1
-            elif parser.commandType == 'A_COMMAND':
-                self.addr_rom += 1
-            elif parser.commandType == 'L_COMMAND':
-                symbol_table.add_entry(parser.symbol, self.addr_rom)
-        print(symbol_table.d_symbol)
-
-        # second pass
-        infile = open(f_name, 'r')
-        parser = Parser(infile)
-        outfile = open(self.prog_name + '.hack', 'w')
-        while parser.has_more_commands():
-            parser.advance()
-            code = None
-            if parser.commandType == 'C_COMMAND':
-                # For each C-instruction, the program concatenates the translated binary codes of the
-                # instruction fields into a single 16-bit word.
-                code = '111' + Code.comp(parser.comp) + Code.dest(parser.dest) + Code.jump(parser.jump)
-                print('C Code: ', code)
-            elif parser.commandType == 'A_COMMAND':
-                # For each A-instruction of type @Xxx, the program translates the
-                # decimal constant returned by the parser into its binary representation
-                try:
-                    parser.symbol = int(parser.symbol)
-                except Exception as e:
-                    if symbol_table.contains(parser.symbol):
-                        parser.symbol = symbol_table.get_address(parser.symbol)
-                    else:
-                        symbol_table.add_entry(parser.symbol, self.addr_ram)
-                        self.addr_ram += 1
-                        parser.symbol = symbol_table.get_address(parser.symbol)
-                    print(e)
-                code = '0' + format(parser.symbol, '015b')
-                # parser.symbol needs to be integer format
-                print('A Code: ', code)
-            elif parser.commandType == 'L_COMMAND':
-                print('L Code: ')
-            if code:
-                outfile.write(code + '\n')
-        infile.close()
-        outfile.close()
+    instructions = Parser(source).tokenize()
+    first_pass(instructions, symbol_table)
+    if optimize_rom:
+        instructions, table, _, _ = optimize(instructions, symbol_table)
+        symbol_table.d_symbol, symbol_table.addr_ram = table.d_symbol, table.addr_ram
+    return second_pass(instructions, symbol_table)
+
+
+class HackAssembler:
+    def __init__(self, f_name, binary=False, source_map=False, optimize_rom=False):
+        # reads xxx.asm, assembles it and writes xxx.hack (or xxx.hackbin); optimize_rom
+        # runs optimize() after pass 1, see rom_map
+        self.prog_name = os.path.splitext(f_name)[0]
+        # counters and per-phase wall-clock seconds, see report()
+        self.counters = {'lines': 0, 'A_COMMAND': 0, 'C_COMMAND': 0, 'L_COMMAND': 0,
+                         'labels': 0, 'variables': 0}
+        self.timings = {}
+        start = time.perf_counter()
+        with open(f_name, 'r') as infile:
+            parser = Parser(infile)
+            instructions = parser.tokenize()
+        self.counters['lines'] = parser.line_no
+        start = self.phase('read', start)
+        self.symbol_table = SymbolTable()
+        self.addr_rom = first_pass(instructions, self.symbol_table, self.counters)
+        self.counters['labels'] = self.counters['L_COMMAND']
+        start = self.phase('pass1', start)
+        # old ROM address -> new one, None for removed instructions
+        self.rom_map = None
+        if optimize_rom:
+            instructions, self.symbol_table, self.rom_map, stats = optimize(instructions, self.symbol_table)
+            self.counters.update(stats)
+            self.addr_rom -= stats['words_saved']
+            start = self.phase('optimize', start)
+        self.words = second_pass(instructions, self.symbol_table)
+        self.addr_ram = self.symbol_table.addr_ram
+        self.counters['variables'] = self.addr_ram - 16
+        start = self.phase('pass2', start)
+        if binary:
+            write_hackbin(self.prog_name + '.hackbin', self.words)
+        else:
+            # the text form is only produced once, for the whole program
+            with open(self.prog_name + '.hack', 'w') as outfile:
+                outfile.write(hack_text(self.words))
+        if source_map:
+            hackmap = {'asm': os.path.basename(f_name), 'lines': rom_lines(instructions)}
+            if self.rom_map is not None:
+                hackmap['addresses'] = self.rom_map
+            with open(self.prog_name + '.hackmap', 'w') as outfile:
+                json.dump(hackmap, outfile, separators=(',', ':'))
+        self.phase('write', start)
+
+    def phase(self, name, start):
+        # record the time since start under name; returns the new start time
+        now = time.perf_counter()
+        self.timings[name] = now - start
+        return now
+
+    def report(self):
+        return {'counters': self.counters, 'timings': self.timings}
 
 
 if __name__ == '__main__':
-    if debug:
-        print("argv[0]: ", sys.argv[0])
-        print("argv[1]: ", sys.argv[1])
-    assembler = HackAssembler(sys.argv[1])
-    if debug:
-        print("program name", assembler.prog_name)
+    if '--verbose' in sys.argv[2:]:
+        debug = True
+        logging.basicConfig(level=logging.DEBUG, format='%(name)s: %(message)s')
+    assembler = HackAssembler(sys.argv[1], binary='--binary' in sys.argv[2:], source_map='--map' in sys.argv[2:],
+                              optimize_rom='--optimize' in sys.argv[2:])
+    if assembler.rom_map is not None:
+        c = assembler.counters
+        print('optimize: %d words saved (%d unreachable), %d jumps threaded, %d jumps to the next '
+              'instruction removed, %d labels removed, ~%d cycles saved per pass over the changed jumps'
+              % (c['words_saved'], c['unreachable'], c['threaded'], c['next_jumps'], c['labels_removed'],
+                 c['cycles_saved']))
+    if '--stats' in sys.argv[2:]:
+        print(json.dumps(assembler.report()))
@@ -0,0 +1,232 @@
+# Lockstep batch emulation of many instances of one Hack program
+# Holds N machine states as NumPy arrays (A, D and PC as length-N vectors, RAM as an
+# N x 32768 int16 matrix) and executes the same ROM for all of them, for fuzzing and
+# property tests that run one program over many different inputs.
+
+# Every step executes one instruction on every running instance. Instances are grouped
+# by PC, so while they agree (the usual case for straight-line code) a step is one
+# vectorized operation over the whole batch; after a data-dependent jump each group
+# runs its own instruction until the PCs meet again. The ALU is a table of vectorized
+# functions built from Code.d_comp, evaluated on int16 arrays whose arithmetic wraps
+# like the Hack ALU. An instance halts at an (END)-style loop, as in HackEmulator.
+
+# NumPy is only needed by this module; HackEmulator does not depend on it.
+
+# Usage: python HackBatch.py xxx.hack [-n N] [--cycles N] [--ram ADDR=VALUE ...]
+#                            [--random ADDR=LO:HI ...] [--seed N] [--show ADDR,...] [--bench]
+# --random gives every instance its own uniform value in [LO, HI] at RAM[ADDR];
+# --show prints those RAM words for the first instances; --bench also runs the
+# instances one by one on HackEmulator, checks they end in the same state and compares
+# the throughput.
+
+import argparse
+import sys
+import time
+from array import array
+from HackAssembler import Code
+from HackEmulator import A_INST, C_INST, DEST_A, DEST_D, DEST_M, HALT, RAM_SIZE, HackEmulator, load_rom, \
+    parse_ram, predecode
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+def comp_vector(bits):
+    # vectorized (A, D, M) -> int16 array function for a 7-bit comp field
+    for c, cb in Code.d_comp.items():
+        if int(cb, 2) == bits:
+            return eval('lambda A, D, M: ' + c.replace('!', '~'))
+    # not one of the documented mnemonics: run the ALU on the raw control bits
+
+    def comp(A, D, M):
+        y = M if bits & 0x40 else A
+        return Code.alu(bits & 0x3F, D.astype(np.int32), y.astype(np.int32)).astype(np.int16)
+    return comp
+
+
+# comp field -> vectorized ALU function, shared by every batch
+d_comp_vector = {}
+
+
+class HackBatch:
+    def __init__(self, rom, n):
+        # rom is any sequence of 16-bit instruction words, n the number of instances
+        if np is None:
+            raise RuntimeError('HackBatch needs NumPy')
+        self.rom = rom
+        self.prog = []
+        for kind, value, _, dest, jump in predecode(rom)[:len(rom)]:
+            comp = None
+            if kind == C_INST:
+                bits = rom[len(self.prog)] >> 6 & 0x7F
+                if bits not in d_comp_vector:
+                    d_comp_vector[bits] = comp_vector(bits)
+                comp = (d_comp_vector[bits], bool(bits & 0x40))
+            self.prog.append((kind, value, comp, dest, jump))
+        self.n = n
+        self.ram = np.zeros((n, RAM_SIZE), dtype=np.int16)
+        # the same RAM as one vector, indexed by instance * RAM_SIZE + address
+        self.flat = self.ram.reshape(-1)
+        self.rows = np.arange(n, dtype=np.int64) * RAM_SIZE
+        self.pc = np.zeros(n, dtype=np.int32)
+        self.a = np.zeros(n, dtype=np.int16)
+        self.d = np.zeros(n, dtype=np.int16)
+        self.cycles = np.zeros(n, dtype=np.int64)
+        self.halted = np.zeros(n, dtype=bool)
+        # instructions executed by all instances together
+        self.steps = 0
+
+    @classmethod
+    def load(cls, f_name, n):
+        return cls(load_rom(f_name), n)
+
+    def groups(self, live):
+        # [(pc, instance indices)] for the running instances; live is None while none
+        # has halted, and a group of the whole batch is slice(None)
+        pcs = self.pc if live is None else self.pc[live]
+        if (pcs == pcs[0]).all():
+            return [(int(pcs[0]), slice(None) if live is None else live)]
+        if live is None:
+            live = np.arange(self.n)
+        order = np.argsort(pcs, kind='stable')
+        pcs, live = pcs[order], live[order]
+        bounds = [0] + list(np.flatnonzero(pcs[1:] != pcs[:-1]) + 1) + [len(pcs)]
+        return [(int(pcs[lo]), live[lo:hi]) for lo, hi in zip(bounds, bounds[1:])]
+
+    def execute(self, pc, idx):
+        # run the instruction at pc on the instances idx, which are all at pc;
+        # returns how many instances ran it
+        count = self.n if isinstance(idx, slice) else len(idx)
+        if pc >= len(self.prog) or self.prog[pc][0] == HALT:
+            self.halted[idx] = True
+            return 0
+        kind, value, comp, dest, jump = self.prog[pc]
+        if kind == A_INST:
+            self.a[idx] = value
+            self.pc[idx] = pc + 1
+        else:
+            fn, uses_m = comp
+            a, d = self.a[idx], self.d[idx]
+            cell = None
+            if uses_m or dest & DEST_M:
+                # flat RAM index of M for every instance in the group
+                cell = (self.rows if isinstance(idx, slice) else idx * RAM_SIZE) + (a & 0x7FFF)
+            out = fn(a, d, self.flat[cell] if uses_m else None)
+            if np.ndim(out) == 0:
+                out = np.full(count, out, dtype=np.int16)
+            if dest & DEST_M:
+                self.flat[cell] = out
+            if dest & DEST_D:
+                self.d[idx] = out
+            if dest & DEST_A:
+                self.a[idx] = out
+                a = out
+            if jump == 7:
+                self.pc[idx] = a & 0x7FFF
+            elif jump:
+                taken = (out < 0) if jump & 4 else np.zeros(count, dtype=bool)
+                if jump & 2:
+                    taken |= out == 0
+                if jump & 1:
+                    taken |= out > 0
+                self.pc[idx] = np.where(taken, a & 0x7FFF, pc + 1)
+            else:
+                self.pc[idx] = pc + 1
+        self.cycles[idx] += 1
+        return count
+
+    def run(self, max_cycles=10 ** 8):
+        # step every instance until it halts or has run max_cycles instructions in this
+        # call; returns the number of steps (instructions per running instance)
+        n = 0
+        while n < max_cycles:
+            live = None
+            if self.halted.any():
+                live = np.flatnonzero(~self.halted)
+                if not len(live):
+                    break
+            executed = 0
+            for pc, idx in self.groups(live):
+                executed += self.execute(pc, idx)
+            if not executed:
+                break
+            self.steps += executed
+            n += 1
+        return n
+
+    def emulator(self, i):
+        # a HackEmulator holding the state of instance i, e.g. to inspect or continue it
+        emulator = HackEmulator(self.rom)
+        emulator.ram = array('h', self.ram[i].tobytes())
+        emulator.pc, emulator.a, emulator.d = int(self.pc[i]), int(self.a[i]), int(self.d[i])
+        emulator.cycles, emulator.halted = int(self.cycles[i]), bool(self.halted[i])
+        return emulator
+
+
+def parse_random(items):
+    # ADDR=LO:HI triples from the command line
+    ranges = []
+    for item in items:
+        addr, span = item.split('=')
+        lo, hi = span.split(':')
+        ranges.append((int(addr), int(lo), int(hi)))
+    return ranges
+
+
+def main(argv):
+    ap = argparse.ArgumentParser(description='Run many instances of a .hack or .hackbin program in lockstep')
+    ap.add_argument('program')
+    ap.add_argument('-n', '--instances', type=int, default=1000)
+    ap.add_argument('--cycles', type=int, default=10 ** 8, help='cycle budget per instance')
+    ap.add_argument('--ram', action='append', default=[], metavar='ADDR=VALUE',
+                    help='initial RAM value for every instance, may be repeated')
+    ap.add_argument('--random', action='append', default=[], metavar='ADDR=LO:HI',
+                    help='random initial RAM value per instance, may be repeated')
+    ap.add_argument('--seed', type=int, default=1)
+    ap.add_argument('--show', default='0', help='comma separated RAM addresses to print')
+    ap.add_argument('--bench', action='store_true', help='also run every instance on HackEmulator and compare')
+    args = ap.parse_args(argv)
+    if np is None:
+        print('HackBatch needs NumPy', file=sys.stderr)
+        return 1
+    rom = load_rom(args.program)
+    batch = HackBatch(rom, args.instances)
+    for addr, value in parse_ram(args.ram):
+        batch.ram[:, addr] = value
+    rng = np.random.default_rng(args.seed)
+    for addr, lo, hi in parse_random(args.random):
+        batch.ram[:, addr] = rng.integers(lo, hi + 1, args.instances)
+    initial = batch.ram.copy() if args.bench else None
+    start = time.perf_counter()
+    steps = batch.run(args.cycles)
+    elapsed = time.perf_counter() - start
+    print('instances: ', args.instances, '(%d halted)' % batch.halted.sum())
+    print('steps: ', steps)
+    print('instance cycles: ', batch.steps)
+    print('instance cycles/sec: ', int(batch.steps / elapsed) if elapsed else 0)
+    show = [int(addr) for addr in args.show.split(',')]
+    for i in range(min(args.instances, 8)):
+        print('instance %d: ' % i, [int(batch.ram[i, addr]) for addr in show])
+    if args.bench:
+        mismatches = 0
+        start = time.perf_counter()
+        emulator = HackEmulator(rom)
+        for i in range(args.instances):
+            emulator.reset()
+            emulator.ram = array('h', initial[i].tobytes())
+            emulator.run(args.cycles)
+            if (emulator.ram != array('h', batch.ram[i].tobytes()) or emulator.cycles != batch.cycles[i]
+                    or (emulator.pc, emulator.a, emulator.d) != (batch.pc[i], batch.a[i], batch.d[i])):
+                mismatches += 1
+        serial = time.perf_counter() - start
+        print('HackEmulator cycles/sec: ', int(batch.steps / serial) if serial else 0)
+        print('speedup: %.1fx' % (serial / elapsed if elapsed else 0))
+        print('mismatching instances: ', mismatches)
+        return 1 if mismatches else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,414 @@
+# Hack CPU emulator that executes the output of HackAssembler in-process
+# The program is read from a text xxx.hack file or a packed xxx.hackbin image
+
+# Usage: python HackEmulator.py xxx.hack [--cycles N] [--ram ADDR=VALUE ...] [--engine interp|blocks] [--bench]
+# Runs until the program reaches an (END)-style self loop or the cycle budget runs out,
+# then prints the cycle count, cycles/sec and RAM[0..15]
+# --bench runs the program on both engines from the same initial state and compares them
+
+# ROM is an array('H') of instruction words, RAM a 32K array('h') of signed 16-bit words.
+# Every ROM word is predecoded once into a dispatch tuple (kind, value, comp, dest, jump)
+# so the run loop never looks at instruction bits.
+# The 'blocks' engine instead compiles each basic block to a Python function on first
+# entry, with A and D held in local variables, and runs a whole block per dispatch.
+
+# Snapshots (xxx.hsnap) hold the machine state: a header page (PC, A, D, cycle count,
+# halted flag and a CRC of the ROM they belong to) followed by RAM as 32K little-endian
+# int16 words at a page-aligned offset. restore() copies RAM in, or with shared=True maps
+# the file copy-on-write so many emulators started from one snapshot share its pages
+# until they write them. fork_map() runs scenarios in forked children of one warm
+# emulator, which share its memory copy-on-write the same way.
+# --save writes a snapshot when the run stops and --restore starts from one, so an
+# expensive prefix (boot, memory initialization) is run once: --cycles N --save warm.hsnap
+
+import argparse
+import mmap
+import os
+import pickle
+import struct
+import sys
+import time
+import zlib
+from array import array
+from HackAssembler import Code, hackbin_bytes, load_hackbin
+
+ROM_SIZE = 32768
+RAM_SIZE = 32768
+
+# dispatch tuple kinds
+A_INST = 0
+C_INST = 1
+HALT = 2
+
+# destination bits of a C-instruction
+DEST_A = 4
+DEST_D = 2
+DEST_M = 1
+
+# snapshot header: magic, version, flags, PC, A, D, cycles, ROM CRC-32, ROM length
+SNAPSHOT_HEADER = struct.Struct('<4sHHHhhqII')
+SNAPSHOT_MAGIC = b'HSNP'
+SNAPSHOT_VERSION = 1
+SNAPSHOT_HALTED = 1
+# RAM starts on a page boundary so it can be mapped straight from the file
+SNAPSHOT_RAM_OFFSET = mmap.ALLOCATIONGRANULARITY
+
+
+def load_rom(f_name):
+    # read a .hack text file or a .hackbin image into an array('H') of words
+    if f_name.endswith('.hackbin'):
+        return array('H', load_hackbin(f_name))
+    with open(f_name, 'r') as infile:
+        return array('H', [int(line, 2) for line in infile.read().split()])
+
+
+def wrap(x):
+    # fold a Python int back into the signed 16-bit range
+    return ((x + 0x8000) & 0xFFFF) - 0x8000
+
+
+def comp_expr(bits):
+    # Python expression over the names A, D and M for a 7-bit comp field
+    for c, cb in Code.d_comp.items():
+        if int(cb, 2) == bits:
+            expr = c.replace('!', '~')
+            if '+' in expr or '-' in expr:
+                # inline form of wrap()
+                expr = '((' + expr + ' + 32768) & 65535) - 32768'
+            return expr
+    # not one of the documented mnemonics: run the ALU on the raw control bits
+    return 'wrap(alu(%d, D, %s))' % (bits & 0x3F, 'M' if bits & 0x40 else 'A')
+
+
+def comp_function(bits):
+    # build a function (A, D, M) -> signed 16-bit result for a 7-bit comp field
+    return eval('lambda A, D, M: ' + comp_expr(bits), {'wrap': wrap, 'alu': Code.alu})
+
+
+# jump field -> condition on the ALU output
+d_jump_cond = {
+    1: 'out > 0',
+    2: 'out == 0',
+    3: 'out >= 0',
+    4: 'out < 0',
+    5: 'out != 0',
+    6: 'out <= 0',
+    7: 'True'
+}
+
+
+# comp field -> ALU function, shared by every emulator instance
+d_comp_fn = {}
+
+
+def predecode(rom):
+    # turn every ROM word into a dispatch tuple, padded to the full 32K ROM with HALT
+    halt = (HALT, 0, None, 0, 0)
+    prog = []
+    for addr, word in enumerate(rom):
+        if not word & 0x8000:
+            prog.append((A_INST, word, None, 0, 0))
+            continue
+        bits = word >> 6 & 0x7F
+        if bits not in d_comp_fn:
+            d_comp_fn[bits] = comp_function(bits)
+        prog.append((C_INST, 0, d_comp_fn[bits], word >> 3 & 7, word & 7))
+    for addr in range(len(rom) - 1):
+        # @addr followed by an unconditional jump that keeps A is an (END) loop
+        word, nxt = rom[addr], rom[addr + 1]
+        if word == addr and nxt & 0x8000 and nxt & 7 == 7 and not nxt & 0x20:
+            prog[addr] = halt
+    prog.extend([halt] * (ROM_SIZE - len(prog)))
+    return prog
+
+
+def block_leaders(rom):
+    # addresses that start a basic block: 0, the instruction after every jump,
+    # and every static jump target (an @value directly followed by a jump)
+    leaders = {0}
+    for addr in range(len(rom) - 1):
+        word, nxt = rom[addr], rom[addr + 1]
+        if word & 0x8000 and word & 7:
+            leaders.add(addr + 1)
+        elif not word & 0x8000 and nxt & 0x8000 and nxt & 7:
+            leaders.add(word)
+    return leaders
+
+
+def compile_block(rom, prog, leaders, start):
+    # translate the straight-line run of instructions from start up to and including
+    # the next jump (or up to the next leader/HALT) into one Python function
+    # block(ram, A, D) -> (next_pc, A, D); returns (function, instruction count)
+    # While A holds a constant loaded by @value it is substituted directly into the
+    # code and only stored to the A variable when the block returns.
+    lines = ['def block(ram, A, D):']
+    a_const = None
+    addr = start
+    while True:
+        kind = prog[addr][0]
+        if kind == HALT:
+            break
+        word = rom[addr]
+        addr += 1
+        if kind == A_INST:
+            a_const = word
+        else:
+            expr = comp_expr(word >> 6 & 0x7F)
+            if a_const is None:
+                expr, cell, target = expr.replace('M', 'ram[A & 32767]'), 'ram[A & 32767]', 'A & 32767'
+            else:
+                cell, target = 'ram[%d]' % a_const, str(a_const)
+                expr = expr.replace('M', cell).replace('A', str(a_const))
+            dest, jump = word >> 3 & 7, word & 7
+            if dest in (DEST_D, DEST_M) and not jump:
+                lines.append('    %s = %s' % ('D' if dest == DEST_D else cell, expr))
+            elif dest or jump:
+                lines.append('    out = ' + expr)
+                if dest & DEST_M:
+                    lines.append('    %s = out' % cell)
+                if dest & DEST_D:
+                    lines.append('    D = out')
+                if dest & DEST_A:
+                    lines.append('    A = out')
+                    a_const, target = None, 'A & 32767'
+            if jump:
+                break
+        if addr in leaders or addr >= len(rom):
+            break
+    if a_const is not None:
+        lines.append('    A = %d' % a_const)
+    if kind == C_INST and jump:
+        lines.append('    return (%s if %s else %d), A, D' % (target, d_jump_cond[jump], addr))
+    else:
+        lines.append('    return %d, A, D' % addr)
+    namespace = {'wrap': wrap, 'alu': Code.alu}
+    exec('\n'.join(lines), namespace)
+    return namespace['block'], addr - start
+
+
+class HackEmulator:
+    def __init__(self, rom):
+        # rom is any sequence of 16-bit instruction words
+        self.rom = rom if isinstance(rom, array) and rom.typecode == 'H' else array('H', rom)
+        self.prog = predecode(self.rom)
+        self.ram = array('h', bytes(2 * RAM_SIZE))
+        self.pc = 0
+        self.a = 0
+        self.d = 0
+        self.cycles = 0
+        self.halted = False
+        # basic-block cache for run_blocks(), built on first use
+        self.blocks = None
+        self.leaders = None
+        # CRC-32 of the ROM that snapshots are tagged with, computed on first use
+        self.rom_crc = None
+
+    @classmethod
+    def load(cls, f_name):
+        return cls(load_rom(f_name))
+
+    def reset(self):
+        # clear the registers and the cycle counter; RAM keeps its contents like the real reset
+        self.pc = 0
+        self.a = 0
+        self.d = 0
+        self.cycles = 0
+        self.halted = False
+
+    def run(self, max_cycles=10 ** 8):
+        # execute until a HALT entry or until max_cycles instructions have run;
+        # returns the number of instructions executed by this call
+        prog, ram = self.prog, self.ram
+        pc, a, d = self.pc, self.a, self.d
+        n = 0
+        while n < max_cycles:
+            kind, value, comp, dest, jump = prog[pc]
+            if kind == A_INST:
+                a = value
+                pc += 1
+            elif kind == C_INST:
+                out = comp(a, d, ram[a & 0x7FFF])
+                if dest:
+                    if dest & DEST_M:
+                        ram[a & 0x7FFF] = out
+                    if dest & DEST_D:
+                        d = out
+                    if dest & DEST_A:
+                        a = out
+                if jump and jump & (4 if out < 0 else 2 if out == 0 else 1):
+                    pc = a & 0x7FFF
+                else:
+                    pc += 1
+            else:
+                self.halted = True
+                break
+            n += 1
+        self.pc, self.a, self.d = pc, a, d
+        self.cycles += n
+        return n
+
+    def run_blocks(self, max_cycles=10 ** 8):
+        # same contract as run(), but executes compiled basic blocks; blocks are cached
+        # by start address. A block that would overrun the budget is run by run(), so
+        # both engines stop after exactly max_cycles instructions
+        if self.blocks is None:
+            self.blocks = {}
+            self.leaders = block_leaders(self.rom)
+        blocks, prog, ram = self.blocks, self.prog, self.ram
+        pc, a, d = self.pc, self.a, self.d
+        n = 0
+        while n < max_cycles:
+            entry = blocks.get(pc)
+            if entry is None:
+                if prog[pc][0] == HALT:
+                    self.halted = True
+                    break
+                entry = blocks[pc] = compile_block(self.rom, prog, self.leaders, pc)
+            if n + entry[1] > max_cycles:
+                break
+            pc, a, d = entry[0](ram, a, d)
+            n += entry[1]
+        self.pc, self.a, self.d = pc, a, d
+        self.cycles += n
+        if n < max_cycles and not self.halted:
+            n += self.run(max_cycles - n)
+        return n
+
+    def rom_digest(self):
+        if self.rom_crc is None:
+            self.rom_crc = zlib.crc32(hackbin_bytes(self.rom))
+        return self.rom_crc
+
+    def snapshot(self, f_name):
+        # write the machine state to f_name
+        header = SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, SNAPSHOT_VERSION, SNAPSHOT_HALTED if self.halted else 0,
+                                      self.pc, self.a, self.d, self.cycles, self.rom_digest(), len(self.rom))
+        ram = array('h', self.ram)
+        if sys.byteorder == 'big':
+            ram.byteswap()
+        with open(f_name, 'wb') as outfile:
+            outfile.write(header.ljust(SNAPSHOT_RAM_OFFSET, b'\0'))
+            outfile.write(ram.tobytes())
+
+    def restore(self, f_name, shared=False):
+        # load the machine state written by snapshot(); the snapshot must come from the
+        # same ROM. shared: map RAM copy-on-write from the file instead of copying it in
+        with open(f_name, 'rb') as infile:
+            header = infile.read(SNAPSHOT_HEADER.size)
+            if len(header) < SNAPSHOT_HEADER.size:
+                raise ValueError('%s: not a snapshot' % f_name)
+            magic, version, flags, pc, a, d, cycles, crc, rom_len = SNAPSHOT_HEADER.unpack(header)
+            if magic != SNAPSHOT_MAGIC or version != SNAPSHOT_VERSION:
+                raise ValueError('%s: not a version %d snapshot' % (f_name, SNAPSHOT_VERSION))
+            if crc != self.rom_digest() or rom_len != len(self.rom):
+                raise ValueError('%s: snapshot of a different program' % f_name)
+            if shared and sys.byteorder == 'little':
+                ram = mmap.mmap(infile.fileno(), 2 * RAM_SIZE, access=mmap.ACCESS_COPY, offset=SNAPSHOT_RAM_OFFSET)
+                self.ram = memoryview(ram).cast('h')
+            else:
+                if not isinstance(self.ram, array):
+                    self.ram = array('h', bytes(2 * RAM_SIZE))
+                infile.seek(SNAPSHOT_RAM_OFFSET)
+                if infile.readinto(memoryview(self.ram).cast('B')) != 2 * RAM_SIZE:
+                    raise ValueError('%s: truncated snapshot' % f_name)
+                if sys.byteorder == 'big':
+                    self.ram.byteswap()
+        self.pc, self.a, self.d, self.cycles = pc, a, d, cycles
+        self.halted = bool(flags & SNAPSHOT_HALTED)
+
+
+def fork_map(emulator, fn, items, workers=None):
+    # [fn(emulator, item) for item in items], each call in a forked child that starts from
+    # the emulator's current state and shares its memory copy-on-write; at most workers
+    # children run at a time. Results come back pickled; an exception in fn is re-raised.
+    workers = workers or os.cpu_count()
+    results = [None] * len(items)
+    running = {}
+    todo = list(enumerate(items))
+    while todo or running:
+        while todo and len(running) < workers:
+            i, item = todo.pop(0)
+            r, w = os.pipe()
+            pid = os.fork()
+            if pid == 0:
+                # the child must never get back into the caller's code, whatever fails
+                status = 1
+                try:
+                    os.close(r)
+                    try:
+                        result = (True, fn(emulator, item))
+                    except BaseException as e:
+                        result = (False, e)
+                    try:
+                        data = pickle.dumps(result)
+                    except BaseException as e:
+                        # the result or exception cannot be pickled: send back its repr
+                        data = pickle.dumps((False, ChildProcessError('forked run %d: cannot pickle %r (%s: %s)'
+                                                                      % (i, result[1], type(e).__name__, e))))
+                    with os.fdopen(w, 'wb') as outfile:
+                        outfile.write(data)
+                    sys.stdout.flush()
+                    status = 0
+                finally:
+                    os._exit(status)
+            os.close(w)
+            running[pid] = (i, os.fdopen(r, 'rb'))
+        # read the first child's result before waiting on it, so a large result cannot
+        # leave it blocked on a full pipe
+        pid, (i, infile) = next(iter(running.items()))
+        with infile:
+            data = infile.read()
+        os.waitpid(pid, 0)
+        del running[pid]
+        if not data:
+            raise ChildProcessError('forked run %d died' % i)
+        ok, result = pickle.loads(data)
+        if not ok:
+            raise result
+        results[i] = result
+    return results
+
+
+def parse_ram(items):
+    # ADDR=VALUE pairs from the command line
+    pairs = []
+    for item in items:
+        addr, value = item.split('=')
+        pairs.append((int(addr), int(value)))
+    return pairs
+
+
+def main(argv):
+    ap = argparse.ArgumentParser(description='Run a .hack or .hackbin program on the Hack CPU')
+    ap.add_argument('program')
+    ap.add_argument('--cycles', type=int, default=10 ** 8, help='cycle budget')
+    ap.add_argument('--ram', action='append', default=[], metavar='ADDR=VALUE',
+                    help='initial RAM value, may be repeated')
+    ap.add_argument('--engine', choices=('interp', 'blocks'), default='interp',
+                    help='single-step interpreter or compiled basic blocks')
+    ap.add_argument('--bench', action='store_true', help='run both engines and compare')
+    ap.add_argument('--restore', metavar='FILE', help='start from this snapshot')
+    ap.add_argument('--save', metavar='FILE', help='write a snapshot when the run stops')
+    args = ap.parse_args(argv)
+    engines = ('interp', 'blocks') if args.bench else (args.engine,)
+    rom = load_rom(args.program)
+    for engine in engines:
+        emulator = HackEmulator(rom)
+        if args.restore:
+            emulator.restore(args.restore, shared=True)
+        for addr, value in parse_ram(args.ram):
+            emulator.ram[addr] = value
+        run = emulator.run if engine == 'interp' else emulator.run_blocks
+        start = time.perf_counter()
+        cycles = run(args.cycles)
+        elapsed = time.perf_counter() - start
+        print('engine: ', engine)
+        print('cycles: ', cycles, 'halted' if emulator.halted else 'budget exhausted')
+        print('cycles/sec: ', int(cycles / elapsed) if elapsed else 0)
+        print('RAM[0..15]: ', list(emulator.ram[:16]))
+        if args.save:
+            emulator.snapshot(args.save)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
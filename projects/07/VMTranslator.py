@@ -1,11 +1,36 @@
+# Usage: python VMTranslator.py xxx.vm|xxx [options]
+# a directory xxx is translated as one program into xxx/xxx.asm
+# --stats prints a JSON dump of the counters and per-phase timings, --verbose logs every line
+# --map also writes xxx.vmmap, the source map from .asm lines to .vm file/line/command
+
+# Library use: translate(source) takes the VM program as a str, bytes or iterable of lines
+# and returns the assembly text without touching disk; translate_lines(source) yields it
+# line by line. VMTranslator(f_name) is the file-to-file driver.
+
+import functools
+import io
+import json
+import logging
+import os
+import re
 import sys
-debug = True
+import time
+debug = False
+log = logging.getLogger('VMTranslator')
 
 
 class Parser:
     # parses each VM command into its lexical elements
-    def __init__(self, f_name):
-        self.file = open(f_name, 'r')
+    def __init__(self, source, location=None):
+        # source is a file name, or any iterable of lines (an open file, stdin, a generator)
+        # location, if given, is the file name put in every command comment as
+        # "// file:line: command" for the source map
+        self.location = location
+        self.file = open(source, 'r') if isinstance(source, str) else None
+        self.lines = iter(self.file if self.file else source)
+        # one line of lookahead replaces the tell/readline/seek probe
+        self.next_line = next(self.lines, None)
+        self.line_no = 0
         self.commandType = None
         self.arg1 = None
         self.arg2 = None
@@ -21,31 +46,38 @@ class Parser:
             "lt": "C_ARITHMETIC",
             "and": "C_ARITHMETIC",
             "or": "C_ARITHMETIC",
-            "not": "C_ARITHMETIC"
+            "not": "C_ARITHMETIC",
+            "label": "C_LABEL",
+            "goto": "C_GOTO",
+            "if-goto": "C_IF",
+            "function": "C_FUNCTION",
+            "call": "C_CALL",
+            "return": "C_RETURN"
         }
 
     def has_more_commands(self):
-        cur_pos = self.file.tell()
-        has_line = bool(self.file.readline())
-        self.file.seek(cur_pos)
-        return has_line
+        return self.next_line is not None
 
     def advance(self):
         self.commandType = None
         self.arg1 = None
         self.arg2 = None
-        line = self.file.readline().rstrip()
+        line = self.next_line.rstrip()
+        self.next_line = next(self.lines, None)
+        self.line_no += 1
         if debug:
-            print('line before: ', line)
+            log.debug('line before: %s', line)
         # comments > text beginning with two slashes (//) and ending at the end of the line is considered a comment and is ignored
         line = line.split('//')[0]
         # move to the next command in file
         if debug:
-            print('line after: ', line)
+            log.debug('line after: %s', line)
         if not line:
-            print('line empty')
             return
-        self.comment = "// " + line + "\n"
+        if self.location:
+            self.comment = "// {0}:{1}: {2}\n".format(self.location, self.line_no, line.strip())
+        else:
+            self.comment = "// " + line + "\n"
         line = line.split()
         if line[0] in self.d_class:
             self.commandType = self.d_class[line[0]]
@@ -57,44 +89,249 @@ class Parser:
             self.arg2 = line[2]
         elif self.commandType == "C_ARITHMETIC":
             self.arg1 = line[0]
+        elif self.commandType in ("C_LABEL", "C_GOTO", "C_IF"):
+            self.arg1 = line[1]
+        elif self.commandType in ("C_FUNCTION", "C_CALL"):
+            self.arg1 = line[1]
+            self.arg2 = line[2]
 
     def close(self):
-        self.file.close()
+        if self.file:
+            self.file.close()
+
+
+class Peephole:
+    # rewrites the emitted instruction stream with a window of local rules that keep the
+    # program's behaviour identical; labels are never matched, so no rule spans a jump target
+    def __init__(self):
+        self.saved = 0
+
+    @staticmethod
+    def plain(line):
+        # a C-instruction that neither writes A nor jumps
+        if line[0] in '@(' or ';' in line or '=' not in line:
+            return False
+        return 'A' not in line.split('=')[0]
+
+    def rewrite(self, w):
+        # first-stage rules; w is the list of upcoming code lines,
+        # returns (lines consumed, replacement) or None
+        if w[:4] == ['@SP', 'M=M+1', '@SP', 'M=M-1']:
+            # push followed by pop: SP goes up and straight back down
+            return 4, ['@SP']
+        if w[:6] == ['@SP', 'AM=M+1', 'A=A-1', 'M=D', '@SP', 'AM=M-1']:
+            # same for the short push form: A ends up at the old stack top either way
+            return 6, ['@SP', 'A=M', 'M=D']
+        if w[:4] == ['@SP', 'M=M-1', '@SP', 'A=M']:
+            return 4, ['@SP', 'AM=M-1']
+        if w[:3] == ['@SP', 'M=M-1', 'A=M']:
+            return 3, ['@SP', 'AM=M-1']
+        if len(w) > 1 and w[0][0] == '@' and w[1][0] == '@':
+            # the first A load is overwritten before it is used
+            return 1, []
+        if len(w) > 4 and w[:2] == ['@SP', 'A=M'] and self.plain(w[2]) and w[3:5] == ['@SP', 'A=M']:
+            # A still holds SP: X only writes D or RAM[SP], never RAM[0]
+            return 5, w[:3]
+        if w[:2] == ['M=D', 'D=M']:
+            return 2, ['M=D']
+        return None
+
+    def rewrite_push(self, w):
+        # second-stage rule, applied once nothing else matches: a push whose A value
+        # is dead afterwards can bump SP first and store below it
+        if len(w) > 5 and w[:5] == ['@SP', 'A=M', 'M=D', '@SP', 'M=M+1'] and w[5][0] == '@':
+            return 5, ['@SP', 'AM=M+1', 'A=A-1', 'M=D']
+        return None
+
+    def run(self, entries, rule):
+        # one pass of rule over (comments, line) entries; returns the rewritten entries
+        # and any comments left over when the last lines were deleted
+        code = [line for comments, line in entries]
+        out = []
+        carry = []
+        i = 0
+        while i < len(entries):
+            match = rule(code[i:i + 6])
+            if match is None:
+                out.append((carry + entries[i][0], entries[i][1]))
+                carry = []
+                i += 1
+                continue
+            n, replacement = match
+            # comments of the consumed lines move to the first line that survives
+            for comments, line in entries[i:i + n]:
+                carry += comments
+            for line in replacement:
+                out.append((carry, line))
+                carry = []
+            self.saved += n - len(replacement)
+            i += n
+        return out, carry
+
+    def optimize(self, text):
+        # returns the optimized text; comment lines are kept with the code they precede
+        entries = []
+        comments = []
+        for line in text.splitlines():
+            if not line or line.startswith('//'):
+                comments.append(line)
+            else:
+                entries.append((comments, line))
+                comments = []
+        for rule in (self.rewrite, self.rewrite_push):
+            while True:
+                saved = self.saved
+                entries, carry = self.run(entries, rule)
+                comments = carry + comments
+                if self.saved == saved:
+                    break
+        lines = []
+        for before, line in entries:
+            lines += before
+            lines.append(line)
+        return '\n'.join(lines + comments) + '\n'
+
+
+class InstructionSelector:
+    # picks the cheapest instruction sequence for a push/pop (or the D-register load/store
+    # parts of one) by segment and index: every applicable pattern is generated, costed by
+    # its instruction count, and the winner is memoized per (command, segment, index)
+    d_base = {
+        "local": "LCL",
+        "argument": "ARG",
+        "this": "THIS",
+        "that": "THAT"
+    }
+
+    def __init__(self, static_name, cache_size=4096):
+        self.static_name = static_name
+        # bounded LRU memo of rendered sequences per (command, segment, index)
+        self.select = functools.lru_cache(maxsize=cache_size)(self.select)
+
+    @staticmethod
+    def cost(code):
+        # one instruction per line; the sequences here never contain labels
+        return code.count("\n")
+
+    def select(self, command, segment, index):
+        # command is C_PUSH, C_POP, LOAD_D (D = segment[index]) or STORE_D (segment[index] = D)
+        return min(self.candidates(command, segment, int(index)), key=self.cost)
+
+    def address(self, segment, index):
+        # @symbol that addresses segment[index] directly, or None for pointer-based segments
+        if segment == "static":
+            return "@{0}.{1}\n".format(self.static_name, index)
+        if segment == "temp":
+            return "@{0}\n".format(index + 5)
+        if segment == "pointer":
+            return "@THAT\n" if index == 1 else "@THIS\n"
+        return None
+
+    def candidates(self, command, segment, index):
+        push_d = ("@SP\nA=M\nM=D\n@SP\nM=M+1\n",
+                  "@SP\nAM=M+1\nA=A-1\nM=D\n")
+        pop_d = "@SP\nAM=M-1\nD=M\n"
+        base = self.d_base.get(segment)
+        if command == "LOAD_D":
+            if segment == "constant":
+                if index in (0, 1, -1):
+                    yield "D={0}\n".format(index)
+                if index >= 0:
+                    yield "@{0}\nD=A\n".format(index)
+                elif index == -32768:
+                    yield "@32767\nD=-A\nD=D-1\n"
+                else:
+                    yield "@{0}\nD=-A\n".format(-index)
+            elif base is None:
+                yield self.address(segment, index) + "D=M\n"
+            else:
+                yield "@{0}\nD=M\n@{1}\nA=D+A\nD=M\n".format(base, index)
+                yield "@{0}\nA=M\n".format(base) + "A=A+1\n" * index + "D=M\n"
+        elif command == "STORE_D":
+            if base is None:
+                yield self.address(segment, index) + "M=D\n"
+            else:
+                yield "@{0}\nA=M\n".format(base) + "A=A+1\n" * index + "M=D\n"
+                yield ("@R13\nM=D\n@{0}\nD=M\n@{1}\nD=D+A\n@R14\nM=D\n@R13\nD=M\n@R14\nA=M\nM=D\n"
+                       .format(base, index))
+        elif command == "C_PUSH":
+            if segment == "constant" and index in (0, 1, -1):
+                # the ALU produces these directly into memory
+                yield "@SP\nAM=M+1\nA=A-1\nM={0}\n".format(index)
+            for load in self.candidates("LOAD_D", segment, index):
+                for push in push_d:
+                    yield load + push
+        elif command == "C_POP":
+            for store in self.candidates("STORE_D", segment, index):
+                yield pop_d + store
+            if base is not None:
+                # compute the address first, then pop straight into it
+                yield ("@{0}\nD=M\n@{1}\nD=D+A\n@R13\nM=D\n".format(base, index) + pop_d +
+                       "@R13\nA=M\nM=D\n")
+                # the original sequence that stashes the address above the stack top
+                yield ("@{0}\nD=M\n@{1}\nD=D+A\n@SP\nM=M-1\nA=M+1\nM=D\nA=A-1\nD=M\nA=A+1\nA=M\nM=D\n"
+                       .format(base, index))
 
 
 class CodeWriter:
     # writes the assembly code that implements the parsed command
-    def __init__(self, prog_name):
+    def __init__(self, prog_name, peephole=False, shared=False, shared_arithmetic=False, tos=False,
+                 comments=True, outfile=None, relocatable=False, inline_calls=False):
         self.cnt = 0
+        # outfile: any object with write() that receives the assembly instead of prog_name.asm
+        self.outfile = outfile
+        # output is collected in self.out and written in chunks of about chunk_size characters
+        self.out = []
+        self.out_size = 0
+        self.chunk_size = 1 << 16
+        # comments=False drops the "// command" lines
+        self.comments = comments
+        # instrumentation: command counts, instructions saved and seconds spent writing
+        self.counters = {'C_PUSH': 0, 'C_POP': 0, 'C_ARITHMETIC': 0, 'C_MOVE': 0, 'C_LABEL': 0, 'C_GOTO': 0,
+                         'C_IF': 0, 'C_FUNCTION': 0, 'C_CALL': 0, 'C_RETURN': 0, 'lines': 0}
+        self.timings = {'write': 0.0, 'translate': 0.0}
+        self.shared = []
+        # top-of-stack caching: the top of the VM stack may live in D instead of RAM[SP-1];
+        # tos_in_d tracks that across commands and spill() writes it back when needed
+        self.tos = tos
+        self.tos_in_d = False
+        # statics are named <file>.<index>, so every file gets its own
+        self.selector = InstructionSelector(os.path.basename(prog_name))
+        # relocatable=True translates one file of a multi-file program for HackLinker:
+        # no (END) loop, and the shared routines are kept apart in self.lib (routine
+        # label -> assembly) so the linker can place one copy of each after all the code
+        self.relocatable = relocatable
+        self.lib = {}
+        # labels other files may refer to
+        self.exports = set()
+        # function calls: call and return jump to the shared __VM_CALL/__VM_RETURN
+        # routines (call through a short stub per argument count) unless inline_calls
+        # asks for the full textbook sequence at every site; labels are scoped to
+        # function_name
+        self.inline_calls = inline_calls
+        self.function_name = None
+        self.call_args = set()
+        self.call_sites = 0
+        self.return_sites = 0
+        # functions with more locals than this zero them with a loop
+        self.locals_loop = 8
         self.prog_name = prog_name
-        self.file = outfile = open(prog_name + '.asm', 'w')
+        # with the peephole pass on, code is collected in memory and optimized on close()
+        self.peephole = Peephole() if peephole else None
+        # "shared for size": these commands call one runtime routine each instead of
+        # inlining their template ("inline for speed"); routines are emitted after (END)
+        self.shared_ops = set()
+        if shared:
+            self.shared_ops.update(("eq", "gt", "lt"))
+        if shared_arithmetic:
+            self.shared_ops.update(("add", "sub", "and", "or"))
+        self.d_calls = {}
+        if peephole:
+            self.file = io.StringIO()
+        else:
+            self.file = outfile or open(prog_name + '.asm', 'w')
+        # push/pop sequences come from the InstructionSelector
         self._d_symbol = {
-            # addr = segmentPointer + i, *SP = *addr, SP++
-            "C_PUSH":
-                ("{0}\n"
-                 "D=A\n"
-                 "@SP\n"
-                 "A=M\n"
-                 "M=D\n"
-                 "@SP\n"
-                 "M=M+1\n"),
-            # addr = segmentPointer + i, *SP--, *addr = *SP
-            "C_POP":
-                ("@SP\n"
-                 "M=M-1\n"
-                 "@SP\n"
-                 "A=M\n"
-                 "D=M\n"
-                 "{0}\n"
-                 "M=D\n"),
-            "C_PUSH_pointer":
-                ("@{0}\n"
-                 "D=A\n"
-                 "@SP\n"
-                 "A=M\n"
-                 "M=D\n"
-                 "@SP\n"
-                 "M=M+1\n"),
             "add": ("@SP\n"
                     "M=M-1\n"
                     "A=M\n"
@@ -213,7 +450,213 @@ class CodeWriter:
                    "M=D\n"
                    "@SP\n"
                    "M=M+1\n"),
-            "C_END": "(END)\n@END\n0;JMP\n"
+            "C_END": "(END)\n@END\n0;JMP\n",
+            # call site of a shared routine: R13 = return address, jump to the routine
+            "C_SHARED_CALL":
+                ("@__VM_RET_{0}\n"
+                 "D=A\n"
+                 "@R13\n"
+                 "M=D\n"
+                 "@__VM_{1}\n"
+                 "0;JMP\n"
+                 "(__VM_RET_{0})\n"),
+            # shared comparison: pops y, replaces x with -1/0, returns through R13
+            "C_SHARED_COMPARE":
+                ("(__VM_{0})\n"
+                 "@SP\n"
+                 "AM=M-1\n"
+                 "D=M\n"
+                 "A=A-1\n"
+                 "D=M-D\n"
+                 "M=-1\n"
+                 "@__VM_{0}_TRUE\n"
+                 "D;{1}\n"
+                 "@SP\n"
+                 "A=M-1\n"
+                 "M=0\n"
+                 "(__VM_{0}_TRUE)\n"
+                 "@R13\n"
+                 "A=M\n"
+                 "0;JMP\n"),
+            # shared binary operation: pops y, replaces x with x op y
+            "C_SHARED_BINARY":
+                ("(__VM_{0})\n"
+                 "@SP\n"
+                 "AM=M-1\n"
+                 "D=M\n"
+                 "A=A-1\n"
+                 "M={1}\n"
+                 "@R13\n"
+                 "A=M\n"
+                 "0;JMP\n"),
+            # call site: R13 = function, D = return address, then the stub for the
+            # argument count; {0} function, {1} return label, {2} argument count
+            "C_CALL_SITE":
+                ("@{0}\n"
+                 "D=A\n"
+                 "@R13\n"
+                 "M=D\n"
+                 "@{1}\n"
+                 "D=A\n"
+                 "@__VM_CALL_{2}\n"
+                 "0;JMP\n"
+                 "({1})\n"),
+            # one stub per argument count: R14 = return address, D = nArgs
+            "C_CALL_STUB":
+                ("(__VM_CALL_{0})\n"
+                 "@R14\n"
+                 "M=D\n"
+                 "@{0}\n"
+                 "D=A\n"
+                 "@__VM_CALL\n"
+                 "0;JMP\n"),
+            # shared call: ARG = SP - nArgs (taken before the frame is pushed), push the
+            # return address and the caller's frame, LCL = SP, jump to the function in R13
+            "C_CALL":
+                ("(__VM_CALL)\n"
+                 "@SP\n"
+                 "D=M-D\n"
+                 "@R15\n"
+                 "M=D\n"
+                 "@R14\n"
+                 "D=M\n"
+                 "@SP\n"
+                 "AM=M+1\n"
+                 "A=A-1\n"
+                 "M=D\n"
+                 "@LCL\n"
+                 "D=M\n"
+                 "@SP\n"
+                 "AM=M+1\n"
+                 "A=A-1\n"
+                 "M=D\n"
+                 "@ARG\n"
+                 "D=M\n"
+                 "@SP\n"
+                 "AM=M+1\n"
+                 "A=A-1\n"
+                 "M=D\n"
+                 "@THIS\n"
+                 "D=M\n"
+                 "@SP\n"
+                 "AM=M+1\n"
+                 "A=A-1\n"
+                 "M=D\n"
+                 "@THAT\n"
+                 "D=M\n"
+                 "@SP\n"
+                 "AM=M+1\n"
+                 "A=A-1\n"
+                 "M=D\n"
+                 "@R15\n"
+                 "D=M\n"
+                 "@ARG\n"
+                 "M=D\n"
+                 "@SP\n"
+                 "D=M\n"
+                 "@LCL\n"
+                 "M=D\n"
+                 "@R13\n"
+                 "A=M\n"
+                 "0;JMP\n"),
+            # shared return: frame = LCL, *ARG = pop(), SP = ARG + 1, restore
+            # THAT/THIS/ARG/LCL from the frame and jump to the saved return address
+            "C_RETURN":
+                ("(__VM_RETURN)\n"
+                 "@LCL\n"
+                 "D=M\n"
+                 "@R13\n"
+                 "M=D\n"
+                 "@5\n"
+                 "A=D-A\n"
+                 "D=M\n"
+                 "@R14\n"
+                 "M=D\n"
+                 "@SP\n"
+                 "AM=M-1\n"
+                 "D=M\n"
+                 "@ARG\n"
+                 "A=M\n"
+                 "M=D\n"
+                 "D=A+1\n"
+                 "@SP\n"
+                 "M=D\n"
+                 "@R13\n"
+                 "AM=M-1\n"
+                 "D=M\n"
+                 "@THAT\n"
+                 "M=D\n"
+                 "@R13\n"
+                 "AM=M-1\n"
+                 "D=M\n"
+                 "@THIS\n"
+                 "M=D\n"
+                 "@R13\n"
+                 "AM=M-1\n"
+                 "D=M\n"
+                 "@ARG\n"
+                 "M=D\n"
+                 "@R13\n"
+                 "AM=M-1\n"
+                 "D=M\n"
+                 "@LCL\n"
+                 "M=D\n"
+                 "@R14\n"
+                 "A=M\n"
+                 "0;JMP\n"),
+            # function entry: zero {1} locals with a loop
+            "C_LOCALS_LOOP":
+                ("@{1}\n"
+                 "D=A\n"
+                 "({0}$$locals)\n"
+                 "@SP\n"
+                 "AM=M+1\n"
+                 "A=A-1\n"
+                 "M=0\n"
+                 "D=D-1\n"
+                 "@{0}$$locals\n"
+                 "D;JGT\n"),
+            # bootstrap: SP = 256, then call Sys.init
+            "C_INIT":
+                ("@256\n"
+                 "D=A\n"
+                 "@SP\n"
+                 "M=D\n")
+        }
+        # templates without placeholders are emitted as they are, with no format() call
+        self._d_plain = {k: v for k, v in self._d_symbol.items() if "{" not in v}
+        # top-of-stack caching templates: y in D, x at the new stack top after @SP AM=M-1
+        self._d_tos_unary = {
+            "neg": "D=-D\n",
+            "not": "D=!D\n"
+        }
+        self._d_tos_binary = {
+            "add": "D=D+M\n",
+            "sub": "D=M-D\n",
+            "and": "D=D&M\n",
+            "or": "D=D|M\n"
+        }
+        self._d_symbol["C_TOS_COMPARE"] = (
+            "@SP\n"
+            "AM=M-1\n"
+            "D=M-D\n"
+            "@TOS_TRUE_{0}\n"
+            "D;J{1}\n"
+            "D=0\n"
+            "@TOS_END_{0}\n"
+            "0;JMP\n"
+            "(TOS_TRUE_{0})\n"
+            "D=-1\n"
+            "(TOS_END_{0})\n")
+        # shared routine bodies: comparisons by jump condition, binary ops by comp field
+        self._d_shared = {
+            "eq": ("C_SHARED_COMPARE", "JEQ"),
+            "gt": ("C_SHARED_COMPARE", "JGT"),
+            "lt": ("C_SHARED_COMPARE", "JLT"),
+            "add": ("C_SHARED_BINARY", "D+M"),
+            "sub": ("C_SHARED_BINARY", "M-D"),
+            "and": ("C_SHARED_BINARY", "D&M"),
+            "or": ("C_SHARED_BINARY", "D|M")
         }
         self._d_segment = {
             "local": "LCL",
@@ -238,150 +681,539 @@ class CodeWriter:
         else:
             return ""
 
+    def emit(self, code):
+        self.out.append(code)
+        self.out_size += len(code)
+        if self.out_size >= self.chunk_size:
+            self.flush()
+
+    def flush(self):
+        start = time.perf_counter()
+        self.file.write(''.join(self.out))
+        self.out = []
+        self.out_size = 0
+        self.timings['write'] += time.perf_counter() - start
+
     def write_comment(self, comment):
-        self.file.write(comment)
+        if self.comments:
+            self.emit(comment)
 
     def write_arithmetic(self, command):
-        self.file.write(self.symbol(command).format(self.cnt))
+        if self.tos:
+            if command not in self.shared_ops:
+                self.write_tos_arithmetic(command)
+                return
+            # shared routines work on the memory stack
+            self.spill()
+        if command in self.shared_ops:
+            self.emit(self.symbol("C_SHARED_CALL").format(self.cnt, command.upper()))
+            self.d_calls[command] = self.d_calls.get(command, 0) + 1
+            self.cnt += 1
+            return
+        if command in self._d_plain:
+            self.emit(self._d_plain[command])
+            return
+        self.emit(self.symbol(command).format(self.cnt))
         if command in ("eq", "lt", "gt"):
             self.cnt += 1
 
-    def write_push_pop(self, command, segment, index):
-        if segment == "constant":
-            self.file.write(self.symbol(command).format("@"+index))
-        elif segment == "static":
-            if command == "C_PUSH":
-                code = (
-                    "@{0}.{1}\n"
-                    "D=M\n"
-                    "@SP\n"
-                    "A=M\n"
-                    "M=D\n"
-                    "@SP\n"
-                    "M=M+1\n"
-                )
-                self.file.write(code.format("StaticText", index))
-            elif command == "C_POP":
-                code = (
-                    "@SP\n"
-                    "AM=M-1\n"
-                    "D=M\n"
-                    "@{0}.{1}\n"
-                    "M=D\n"
-                )
-                self.file.write(code.format("StaticText", index))
-        elif segment == "temp":
-            # push:     addr = 5 + i, *SP = *addr, SP++
-            if command == "C_PUSH":
-                code = ("{0}\n"
-                 "D=M\n"
-                 "@SP\n"
-                 "A=M\n"
-                 "M=D\n"
-                 "@SP\n"
-                 "M=M+1\n")
-                self.file.write(code.format(f"@{int(index)+5}"))
-            # pop:     addr = 5 + i, *SP --, *addr = *SP
-            elif command == "C_POP":
-                self.file.write(self.symbol(command).format(f"@{int(index)+5}"))
-        elif segment == "pointer":
-            if index == "0":
-                segment = self.seg_var("this")
-            elif index == "1":
-                segment = self.seg_var("that")
-            if command == "C_PUSH":
-                # push:     *SP = THIS, SP++
-                code = (
-                    "@{0}\n"
-                    "D=M\n"
-                    "@SP\n"
-                    "A=M\n"
-                    "M=D\n"
-                    "@SP\n"
-                    "M=M+1\n"
-                )
-                self.file.write(code.format(segment))
-            elif command == "C_POP":
-                # pop:      SP--, THAT = *SP
-                code = (
-                    "@SP\n"
-                    "M=M-1\n"
-                    "@SP\n"
-                    "A=M\n"
-                    "D=M\n"
-                    "@{0}\n"
-                    "M=D\n"
-                )
-                self.file.write(code.format(segment))
+    def routines(self):
+        # the runtime routines the program calls, by label
+        routines = {}
+        for command in sorted(self.d_calls):
+            template, arg = self._d_shared[command]
+            routines["__VM_" + command.upper()] = self.symbol(template).format(command.upper(), arg)
+        for n in sorted(self.call_args):
+            routines["__VM_CALL_%d" % n] = self.symbol("C_CALL_STUB").format(n)
+        if self.call_args:
+            routines["__VM_CALL"] = self.symbol("C_CALL")
+        if self.return_sites and not self.inline_calls:
+            routines["__VM_RETURN"] = self.symbol("C_RETURN")
+        return routines
+
+    def write_shared(self):
+        # emit the runtime routines that were called, and report the size trade-off
+        for label, routine in self.routines().items():
+            if self.relocatable:
+                self.lib[label] = routine
+                continue
+            self.write_comment("// shared " + label + "\n")
+            self.emit(routine)
+        self.shared = self.shared_report()
+        for line in self.shared:
+            log.info('%s', line)
+
+    def shared_report(self):
+        # ROM words per command: inline template per site vs. call sites + one routine;
+        # on the executed path a shared call adds 9 instructions (6 at the call site,
+        # 3 to return), partly offset by the routines' shorter bodies
+        def words(text):
+            return sum(1 for line in text.splitlines() if line and line[0] not in '(/')
+        lines = []
+        for command, sites in sorted(self.d_calls.items()):
+            template, arg = self._d_shared[command]
+            inline = words(self.symbol(command)) * sites
+            site = words(self.symbol("C_SHARED_CALL"))
+            routine = words(self.symbol(template))
+            lines.append('shared %s: %d sites, %d words inline, %d words shared (%d/site + %d routine)'
+                         % (command, sites, inline, site * sites + routine, site, routine))
+        if self.call_sites and not self.inline_calls:
+            inline = words(self.inline_call("f", 0, "r")) * self.call_sites
+            site = words(self.symbol("C_CALL_SITE"))
+            stubs = words(self.symbol("C_CALL_STUB")) * len(self.call_args)
+            routine = words(self.symbol("C_CALL"))
+            lines.append('shared call: %d sites, %d words inline, %d words shared (%d/site + %d stubs + %d routine)'
+                         % (self.call_sites, inline, site * self.call_sites + stubs + routine, site, stubs, routine))
+        if self.return_sites and not self.inline_calls:
+            routine = words(self.symbol("C_RETURN"))
+            lines.append('shared return: %d sites, %d words inline, %d words shared (2/site + %d routine)'
+                         % (self.return_sites, routine * self.return_sites, 2 * self.return_sites + routine,
+                            routine))
+        return lines
+
+    def set_file_name(self, name):
+        # start translating another file into the same output: its own statics
+        self.selector = InstructionSelector(name)
+        self.function_name = None
+
+    def scoped(self, label):
+        # a label belongs to the function it appears in
+        return self.function_name + "$" + label if self.function_name else label
+
+    def write_init(self):
+        # bootstrap code: SP = 256, call Sys.init
+        self.write_comment("// bootstrap\n")
+        self.emit(self.symbol("C_INIT"))
+        self.write_call("Sys.init", 0)
+
+    def write_label(self, label):
+        if self.tos:
+            self.spill()
+        self.emit("({0})\n".format(self.scoped(label)))
+
+    def write_goto(self, label):
+        if self.tos:
+            self.spill()
+        self.emit("@{0}\n0;JMP\n".format(self.scoped(label)))
+
+    def write_if(self, label):
+        # pop the condition and jump if it is not zero
+        if self.tos:
+            self.fill()
+            self.tos_in_d = False
         else:
-            if command == "C_PUSH":
-                code = (
-                 "@{0}\n"
-                 "D=M\n"
-                 "@{1}\n"
-                 "A=D+A\n"
-                 "D=M\n"
-                 "@SP\n"
-                 "A=M\n"
-                 "M=D\n"
-                 "@SP\n"
-                 "M=M+1\n")
-                self.file.write(code.format(self.seg_var(segment), index))
-            elif command == "C_POP":
-                code = (
-                 "@{0}\n"
-                 "D=M\n"
-                 "@{1}\n"
-                 "D=D+A\n"
-                 "@SP\n"
-                 "M=M-1\n"
-                 "A=M+1\n"
-                 "M=D\n"
-                 "A=A-1\n"
-                 "D=M\n"
-                 "A=A+1\n"
-                 "A=M\n"
-                 "M=D\n")
-                self.file.write(code.format(self.seg_var(segment), index))
+            self.emit("@SP\nAM=M-1\nD=M\n")
+        self.emit("@{0}\nD;JNE\n".format(self.scoped(label)))
+
+    def write_function(self, name, n_locals):
+        # function entry label, then n_locals zeros pushed onto the stack
+        self.function_name = name
+        self.exports.add(name)
+        self.tos_in_d = False
+        self.emit("({0})\n".format(name))
+        n = int(n_locals)
+        if n <= 2:
+            self.emit("@SP\nAM=M+1\nA=A-1\nM=0\n" * n)
+        elif n <= self.locals_loop:
+            # store the zeros through A, then move SP once
+            self.emit("@SP\nA=M\n" + "M=0\nA=A+1\n" * n + "D=A\n@SP\nM=D\n")
+        else:
+            self.emit(self.symbol("C_LOCALS_LOOP").format(name, n))
+
+    def inline_call(self, name, n, ret):
+        # the textbook call sequence: push the return address and the caller's frame,
+        # reposition ARG and LCL, jump
+        push = "@SP\nAM=M+1\nA=A-1\nM=D\n"
+        code = "@{0}\nD=A\n".format(ret) + push
+        for pointer in ("LCL", "ARG", "THIS", "THAT"):
+            code += "@{0}\nD=M\n".format(pointer) + push
+        return code + ("@SP\nD=M\n@{0}\nD=D-A\n@ARG\nM=D\n@SP\nD=M\n@LCL\nM=D\n@{1}\n0;JMP\n({2})\n"
+                       .format(n + 5, name, ret))
+
+    def write_call(self, name, n_args):
+        if self.tos:
+            self.spill()
+        n = int(n_args)
+        ret = "{0}$ret.{1}".format(self.function_name or "__VM", self.cnt)
+        self.cnt += 1
+        self.call_sites += 1
+        if self.inline_calls:
+            self.emit(self.inline_call(name, n, ret))
+            return
+        self.call_args.add(n)
+        self.emit(self.symbol("C_CALL_SITE").format(name, ret, n))
+
+    def write_return(self):
+        if self.tos:
+            self.spill()
+        self.return_sites += 1
+        if self.inline_calls:
+            # the shared routine's body without its label
+            self.emit(self.symbol("C_RETURN").split("\n", 1)[1])
+            return
+        self.emit("@__VM_RETURN\n0;JMP\n")
+
+    def load_d(self, segment, index):
+        # D = segment[index]
+        return self.selector.select("LOAD_D", segment, index)
+
+    def store_d(self, segment, index):
+        # segment[index] = D
+        return self.selector.select("STORE_D", segment, index)
+
+    def write_move(self, src_segment, src_index, segment, index):
+        # fused "push src / pop dst": copy memory to memory without touching the stack
+        if self.tos:
+            self.spill()
+        load = self.load_d(src_segment, src_index)
+        choices = [load + self.store_d(segment, index)]
+        if segment in self.selector.d_base:
+            # destination address goes to R13 first, D is then free for the value
+            choices.append("@{0}\nD=M\n@{1}\nD=D+A\n@R13\nM=D\n".format(self.seg_var(segment), index) +
+                           load + "@R13\nA=M\nM=D\n")
+        self.emit(min(choices, key=self.selector.cost))
+
+    def spill(self):
+        # top-of-stack caching: write the value held in D back to the stack
+        if self.tos_in_d:
+            self.emit("@SP\nAM=M+1\nA=A-1\nM=D\n")
+            self.tos_in_d = False
+
+    def fill(self):
+        # top-of-stack caching: make sure D holds the top of the stack (popping it)
+        if not self.tos_in_d:
+            self.emit("@SP\nAM=M-1\nD=M\n")
+            self.tos_in_d = True
+
+    def write_tos_push_pop(self, command, segment, index):
+        if command == "C_PUSH":
+            self.spill()
+            self.emit(self.load_d(segment, index))
+            self.tos_in_d = True
+        elif command == "C_POP":
+            self.fill()
+            self.emit(self.store_d(segment, index))
+            self.tos_in_d = False
+
+    def write_tos_arithmetic(self, command):
+        # y is (or is brought) in D, x is popped from memory, the result stays in D
+        self.fill()
+        if command in self._d_tos_unary:
+            self.emit(self._d_tos_unary[command])
+        elif command in self._d_tos_binary:
+            self.emit("@SP\nAM=M-1\n" + self._d_tos_binary[command])
+        else:
+            self.emit(self.symbol("C_TOS_COMPARE").format(self.cnt, command.upper()))
+            self.cnt += 1
+
+    def write_push_pop(self, command, segment, index):
+        if self.tos:
+            self.write_tos_push_pop(command, segment, index)
+            return
+        self.emit(self.selector.select(command, segment, index))
 
     def close(self):
         self.write_comment("//end\n")
-        self.file.write(self.symbol("C_END"))
-        self.file.close()
+        if self.tos:
+            self.spill()
+        if not self.relocatable:
+            self.emit(self.symbol("C_END"))
+        self.write_shared()
+        self.flush()
+        if self.peephole:
+            start = time.perf_counter()
+            text = self.peephole.optimize(self.file.getvalue())
+            self.timings['peephole'] = time.perf_counter() - start
+            self.counters['peephole_saved'] = self.peephole.saved
+            log.info('peephole: instructions saved: %d', self.peephole.saved)
+            start = time.perf_counter()
+            if self.outfile:
+                self.outfile.write(text)
+            else:
+                with open(self.prog_name + '.asm', 'w') as outfile:
+                    outfile.write(text)
+            self.timings['write'] += time.perf_counter() - start
+        if self.file is not self.outfile:
+            self.file.close()
 
 
-class VMTranslator:
-    # drives the process
-    def __init__(self, f_name):
-        l_split = f_name.split('.')
-        # Parser handles the input file
-        parser = Parser(f_name)
-        code_writer = CodeWriter(l_split[0])
-        while parser.has_more_commands():
-            parser.advance()
-            command = None
-            # CodeWriter to handle the input file - uses class methods and is not instantiated
-            if parser.commandType == "C_PUSH":
-                code_writer.write_comment(parser.comment)
-                code_writer.write_push_pop(parser.commandType, parser.arg1, parser.arg2)
-            elif parser.commandType == "C_POP":
-                code_writer.write_comment(parser.comment)
-                code_writer.write_push_pop(parser.commandType, parser.arg1, parser.arg2)
-            elif parser.commandType == "C_ARITHMETIC":
-                code_writer.write_comment(parser.comment)
-                code_writer.write_arithmetic(parser.arg1)
-
-        parser.close()
+def wrap(x):
+    # fold a Python int back into the signed 16-bit range
+    return ((x + 0x8000) & 0xFFFF) - 0x8000
+
+
+class VMOptimizer:
+    # IR stage between Parser and CodeWriter: buffers a window of pushes so that
+    # arithmetic on constants is folded at compile time and "push X / pop Y" pairs are
+    # fused into one C_MOVE; everything else is handed on unchanged, in order
+    d_unary = {
+        "neg": lambda x: wrap(-x),
+        "not": lambda x: ~x
+    }
+    # comparisons follow the generated code, which tests the sign of the 16-bit x - y
+    d_binary = {
+        "add": lambda x, y: wrap(x + y),
+        "sub": lambda x, y: wrap(x - y),
+        "and": lambda x, y: x & y,
+        "or": lambda x, y: x | y,
+        "eq": lambda x, y: -1 if wrap(x - y) == 0 else 0,
+        "gt": lambda x, y: -1 if wrap(x - y) > 0 else 0,
+        "lt": lambda x, y: -1 if wrap(x - y) < 0 else 0
+    }
+
+    def __init__(self, sink, window=2):
+        # sink(commandType, arg1, arg2, comment) receives the optimized commands
+        self.sink = sink
+        self.window = window
+        self.pending = []
+        self.folded = 0
+        self.fused = 0
+
+    def is_constant(self, n):
+        # the top n pending commands are all constant pushes
+        return len(self.pending) >= n and all(cmd[1] == "constant" for cmd in self.pending[-n:])
+
+    def flush(self):
+        for cmd in self.pending:
+            self.sink(*cmd)
+        self.pending = []
+
+    def command(self, commandType, arg1, arg2, comment):
+        if commandType == "C_PUSH":
+            self.pending.append((commandType, arg1, arg2, comment))
+            if len(self.pending) > self.window:
+                self.sink(*self.pending.pop(0))
+        elif commandType == "C_ARITHMETIC" and arg1 in self.d_unary and self.is_constant(1):
+            cmd = self.pending.pop()
+            value = self.d_unary[arg1](int(cmd[2]))
+            self.pending.append(("C_PUSH", "constant", str(value), cmd[3] + comment))
+            self.folded += 1
+        elif commandType == "C_ARITHMETIC" and arg1 in self.d_binary and self.is_constant(2):
+            y = self.pending.pop()
+            x = self.pending.pop()
+            value = self.d_binary[arg1](int(x[2]), int(y[2]))
+            self.pending.append(("C_PUSH", "constant", str(value), x[3] + y[3] + comment))
+            self.folded += 1
+        elif commandType == "C_POP" and self.pending:
+            src = self.pending.pop()
+            self.flush()
+            self.fused += 1
+            if (src[1], src[2]) != (arg1, arg2) or src[1] == "constant":
+                self.sink("C_MOVE", (src[1], src[2]), (arg1, arg2), src[3] + comment)
+        else:
+            self.flush()
+            self.sink(commandType, arg1, arg2, comment)
+
+
+def write_command(code_writer, commandType, arg1, arg2, comment):
+    # hand one (possibly optimized) command to the CodeWriter
+    code_writer.counters[commandType] += 1
+    code_writer.write_comment(comment)
+    if commandType == "C_PUSH":
+        code_writer.write_push_pop(commandType, arg1, arg2)
+    elif commandType == "C_POP":
+        code_writer.write_push_pop(commandType, arg1, arg2)
+    elif commandType == "C_ARITHMETIC":
+        code_writer.write_arithmetic(arg1)
+    elif commandType == "C_MOVE":
+        code_writer.write_move(arg1[0], arg1[1], arg2[0], arg2[1])
+    elif commandType == "C_LABEL":
+        code_writer.write_label(arg1)
+    elif commandType == "C_GOTO":
+        code_writer.write_goto(arg1)
+    elif commandType == "C_IF":
+        code_writer.write_if(arg1)
+    elif commandType == "C_FUNCTION":
+        code_writer.write_function(arg1, arg2)
+    elif commandType == "C_CALL":
+        code_writer.write_call(arg1, arg2)
+    elif commandType == "C_RETURN":
+        code_writer.write_return()
+
+
+def translate_commands(parser, code_writer, fold=False, close=True):
+    # drive parser -> (VMOptimizer) -> code_writer; a generator that pauses after every
+    # command so callers can pick up the output as it is produced. close=False leaves
+    # the code_writer open for the next file of a multi-file program.
+    write = functools.partial(write_command, code_writer)
+    # with fold on, commands go through the VMOptimizer window before code generation
+    optimizer = VMOptimizer(write) if fold else None
+    start = time.perf_counter()
+    write_time = code_writer.timings['write']
+    while parser.has_more_commands():
+        parser.advance()
+        if parser.commandType is None:
+            continue
+        if optimizer:
+            optimizer.command(parser.commandType, parser.arg1, parser.arg2, parser.comment)
+        else:
+            write(parser.commandType, parser.arg1, parser.arg2, parser.comment)
+        yield
+    if optimizer:
+        optimizer.flush()
+        code_writer.counters['folded'] = code_writer.counters.get('folded', 0) + optimizer.folded
+        code_writer.counters['fused'] = code_writer.counters.get('fused', 0) + optimizer.fused
+        log.info('fold: constants folded: %d push/pop pairs fused: %d', optimizer.folded, optimizer.fused)
+    code_writer.counters['lines'] += parser.line_no
+    # parse + code generation; chunk writes made along the way are counted under 'write'
+    code_writer.timings['translate'] += time.perf_counter() - start - (code_writer.timings['write'] - write_time)
+    parser.close()
+    if close:
         code_writer.close()
 
 
+class LineSink:
+    # file-like collector that lets CodeWriter output be consumed line by line
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, text):
+        self.chunks.append(text)
+
+    def drain(self):
+        text = ''.join(self.chunks)
+        self.chunks = []
+        return text.splitlines()
+
+
+class SourceMapWriter:
+    # file-like wrapper that passes the assembly on to outfile and builds the source map
+    # from the comments going by: every comment line starts a region
+    # [asm_line, vm_file, vm_line, command, function] that runs up to the next one.
+    # Command comments carry their location ("// file:line: command", see Parser);
+    # other comments (bootstrap, shared routines, end) become regions without a file.
+    r_location = re.compile(r'(\S+):(\d+): (.*)$')
+
+    def __init__(self, outfile):
+        self.outfile = outfile
+        self.line_no = 0
+        self.partial = ''
+        self.function = None
+        self.regions = []
+
+    def write(self, text):
+        self.outfile.write(text)
+        lines = (self.partial + text).split('\n')
+        self.partial = lines.pop()
+        for line in lines:
+            self.line_no += 1
+            if line.startswith('//'):
+                self.region(line[2:].strip())
+
+    def region(self, comment):
+        match = self.r_location.match(comment)
+        if match is None:
+            self.regions.append([self.line_no, None, 0, comment, None])
+            return
+        command = match.group(3)
+        if command.startswith('function '):
+            self.function = command.split()[1]
+        self.regions.append([self.line_no, match.group(1), int(match.group(2)), command, self.function])
+
+    def save(self, f_name, asm_name):
+        with open(f_name, 'w') as outfile:
+            json.dump({'asm': asm_name, 'regions': self.regions}, outfile, separators=(',', ':'))
+
+
+def translate_lines(lines, prog_name="Main", fold=False, **options):
+    # generator: VM source lines in, assembly lines out, with no file written;
+    # options are the CodeWriter flags (peephole, shared, shared_arithmetic, tos, comments)
+    sink = LineSink()
+    code_writer = CodeWriter(prog_name, outfile=sink, **options)
+    for _ in translate_commands(Parser(lines), code_writer, fold):
+        if sink.chunks:
+            yield from sink.drain()
+    yield from sink.drain()
+
+
+def translate(source, prog_name="Main", fold=False, **options):
+    # VM source (str, bytes or an iterable of lines) in, assembly text out, with no file
+    # opened; options are the CodeWriter flags as for translate_lines
+    if isinstance(source, bytes):
+        source = source.decode()
+    if isinstance(source, str):
+        source = source.splitlines()
+    outfile = io.StringIO()
+    code_writer = CodeWriter(prog_name, outfile=outfile, **options)
+    for _ in translate_commands(Parser(source), code_writer, fold):
+        pass
+    return outfile.getvalue()
+
+
+def program_files(f_name):
+    # (files, prog_name, bootstrap) for a .vm file or a directory of them: a directory is
+    # one program named after it, started by the bootstrap code when it has a Sys.vm
+    if os.path.isdir(f_name):
+        f_name = f_name.rstrip(os.sep)
+        files = sorted(os.path.join(f_name, f) for f in os.listdir(f_name) if f.endswith('.vm'))
+        bootstrap = any(os.path.basename(f) == 'Sys.vm' for f in files)
+        return files, os.path.join(f_name, os.path.basename(f_name)), bootstrap
+    return [f_name], os.path.splitext(f_name)[0], False
+
+
+def translate_files(files, prog_name, outfile, fold=False, bootstrap=False, source_map=False, **options):
+    # translate .vm files, in order, into one program written to outfile; options are the
+    # CodeWriter flags. With source_map the output goes through a SourceMapWriter, kept
+    # as code_writer.source_map. Returns the CodeWriter.
+    if source_map:
+        # the map is read off the command comments, so they stay on
+        outfile = SourceMapWriter(outfile)
+        options['comments'] = True
+    code_writer = CodeWriter(prog_name, outfile=outfile, **options)
+    code_writer.source_map = outfile if source_map else None
+    if bootstrap:
+        code_writer.write_init()
+    for f in files:
+        code_writer.set_file_name(os.path.splitext(os.path.basename(f))[0])
+        with open(f, 'r') as infile:
+            parser = Parser(infile, os.path.basename(f) if source_map else None)
+            for _ in translate_commands(parser, code_writer, fold, close=False):
+                pass
+    code_writer.close()
+    return code_writer
+
+
+class VMTranslator:
+    # drives the process: reads xxx.vm and writes xxx.asm next to it, or translates every
+    # .vm file in directory xxx into xxx/xxx.asm (see program_files)
+    def __init__(self, f_name, peephole=False, shared=False, shared_arithmetic=False, fold=False, tos=False,
+                 comments=True, inline_calls=False, source_map=False):
+        files, prog_name, bootstrap = program_files(f_name)
+        with open(prog_name + '.asm', 'w') as outfile:
+            self.code_writer = translate_files(files, prog_name, outfile, fold, bootstrap, source_map,
+                                               peephole=peephole, shared=shared,
+                                               shared_arithmetic=shared_arithmetic, tos=tos, comments=comments,
+                                               inline_calls=inline_calls)
+        if source_map:
+            self.code_writer.source_map.save(prog_name + '.vmmap', os.path.basename(prog_name) + '.asm')
+
+    def report(self):
+        report = {'counters': self.code_writer.counters, 'timings': self.code_writer.timings}
+        if self.code_writer.shared:
+            report['shared'] = self.code_writer.shared
+        return report
+
+
 if __name__ == '__main__':
     # StackArithmetic\SimpleAdd\SimpleAdd.vm
     # StackArithmetic\StackTest\StackTest.vm
     # MemoryAccess\BasicTest\BasicTest.vm
     # MemoryAccess\PointerTest\PointerTest.vm
     # MemoryAccess\StaticTest\StaticTest.vm
-    if debug:
-        print("argv[0]: ", sys.argv[0])
-        print("argv[1]: ", sys.argv[1])
-    translator = VMTranslator(sys.argv[1])
+    if '--verbose' in sys.argv[2:]:
+        debug = True
+        logging.basicConfig(level=logging.DEBUG, format='%(name)s: %(message)s')
+    # --peephole runs the peephole optimizer over the generated assembly
+    # --shared calls shared eq/gt/lt routines, --shared-arith also add/sub/and/or (smaller, slower)
+    # --fold folds constant arithmetic and fuses push/pop pairs before code generation
+    # --tos keeps the top of the VM stack in D between commands
+    # --no-comments leaves the "// command" lines out of the .asm
+    # --inline-calls expands call/return in place instead of using the shared routines
+    translator = VMTranslator(sys.argv[1], peephole='--peephole' in sys.argv[2:],
+                              shared='--shared' in sys.argv[2:], shared_arithmetic='--shared-arith' in sys.argv[2:],
+                              fold='--fold' in sys.argv[2:], tos='--tos' in sys.argv[2:],
+                              comments='--no-comments' not in sys.argv[2:],
+                              inline_calls='--inline-calls' in sys.argv[2:],
+                              source_map='--map' in sys.argv[2:])
+    if '--stats' in sys.argv[2:]:
+        print(json.dumps(translator.report()))
@@ -0,0 +1,222 @@
+# Benchmark suite for the HackAssembler (06) and VMTranslator (07) tools
+# Generates seeded synthetic .asm and .vm programs at several sizes, runs each tool on
+# each program in a fresh interpreter (so peak RSS belongs to that one run) and records
+# lines/sec, peak RSS and output size. Results are written as JSON; given a stored
+# baseline the run is compared against it and any case slower or bigger than the
+# tolerance is reported as a regression.
+
+# Usage: python HackBench.py [--sizes 10000,100000,1000000] [--tools asm,vm] [--seed N]
+#                            [--repeat N] [-o results.json] [--baseline baseline.json]
+#                            [--tolerance 0.10] [--work-dir DIR]
+# The full range is --sizes 10000,100000,1000000,10000000 (the 10M cases take minutes).
+# Exits 1 if the baseline comparison found a regression.
+
+import argparse
+import json
+import os
+import platform
+import random
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, '06'))
+sys.path.insert(0, os.path.join(HERE, '07'))
+
+DEFAULT_SIZES = (10000, 100000, 1000000)
+
+ASM_COMPS = ('0', '1', '-1', 'D', 'A', '!D', '!A', '-D', '-A', 'D+1', 'A+1', 'D-1', 'A-1',
+             'D+A', 'D-A', 'A-D', 'D&A', 'D|A', 'M', '!M', '-M', 'M+1', 'M-1', 'D+M', 'D-M',
+             'M-D', 'D&M', 'D|M')
+ASM_DESTS = (None, 'M', 'D', 'MD', 'A', 'AM', 'AD', 'AMD')
+ASM_JUMPS = (None, 'JGT', 'JEQ', 'JGE', 'JLT', 'JNE', 'JLE', 'JMP')
+
+VM_SEGMENTS = ('local', 'argument', 'this', 'that', 'temp', 'pointer', 'static', 'constant')
+VM_ARITHMETIC = ('add', 'sub', 'neg', 'eq', 'gt', 'lt', 'and', 'or', 'not')
+
+
+def gen_asm(n, seed=0, labels=0.05, variables=0.10, symbols=0.10, constants=0.20, n_variables=200,
+            forward=5):
+    # n lines of assembly; labels is the share of label declarations, the other ratios
+    # the share of @variable, @label and @constant among the instructions, the rest
+    # being random C-instructions.
+    # Every label address must fit in 15 bits: labels are only declared below ROM
+    # address 32768, and the forward labels (referenced before they are declared) are
+    # declared at the end or at address 32767, whichever comes first.
+    rnd = random.Random(seed)
+    n_labels = rom = 0
+    pending = forward
+    for i in range(n):
+        if pending and rom == 32767:
+            for j in range(n_labels, n_labels + pending):
+                yield '(L%d)' % j
+            n_labels += pending
+            pending = 0
+        if rnd.random() < labels and rom < 32768:
+            yield '(L%d)' % n_labels
+            n_labels += 1
+            continue
+        rom += 1
+        r = rnd.random()
+        if r < variables:
+            yield '@var%d  // variable' % rnd.randrange(n_variables)
+        elif r < variables + symbols:
+            # a few forward references to labels not declared yet
+            yield '@L%d' % rnd.randrange(n_labels + pending)
+        elif r < variables + symbols + constants:
+            yield '@%d' % rnd.randrange(32768)
+        else:
+            c = rnd.choice(ASM_COMPS)
+            d, j = rnd.choice(ASM_DESTS), rnd.choice(ASM_JUMPS)
+            yield '    ' + (d + '=' if d else '') + c + (';' + j if j else '')
+    # every forward reference must resolve
+    for j in range(n_labels, n_labels + pending):
+        yield '(L%d)' % j
+
+
+def vm_index(rnd, segment):
+    if segment == 'pointer':
+        return rnd.randrange(2)
+    if segment == 'temp':
+        return rnd.randrange(8)
+    return rnd.randrange(20)
+
+
+def gen_vm(n, seed=0, push=0.45, pop=0.25):
+    # n VM commands: pushes over every segment, pops over every writable segment,
+    # and the rest arithmetic and comparisons
+    rnd = random.Random(seed)
+    for i in range(n):
+        r = rnd.random()
+        if r < push:
+            segment = rnd.choice(VM_SEGMENTS)
+            yield 'push %s %d' % (segment, vm_index(rnd, segment))
+        elif r < push + pop:
+            segment = rnd.choice(VM_SEGMENTS[:-1])
+            yield 'pop %s %d' % (segment, vm_index(rnd, segment))
+        else:
+            yield rnd.choice(VM_ARITHMETIC)
+
+
+d_generator = {'asm': (gen_asm, '.asm'), 'vm': (gen_vm, '.vm')}
+
+
+def generate(tool, n, seed, work_dir):
+    # write the synthetic program once per (tool, size, seed) and reuse it across runs
+    gen, ext = d_generator[tool]
+    f_name = os.path.join(work_dir, 'bench_%s_%d_%d%s' % (tool, n, seed, ext))
+    if not os.path.exists(f_name):
+        with open(f_name, 'w') as outfile:
+            for line in gen(n, seed):
+                outfile.write(line + '\n')
+    return f_name
+
+
+def output_path(f_name):
+    return os.path.splitext(f_name)[0] + ('.asm' if f_name.endswith('.vm') else '.hack')
+
+
+def run_one(tool, f_name):
+    # child side: run one tool on one file and print seconds and peak RSS as JSON
+    if tool == 'asm':
+        from HackAssembler import HackAssembler as Tool
+    else:
+        from VMTranslator import VMTranslator as Tool
+    start = time.perf_counter()
+    Tool(f_name)
+    seconds = time.perf_counter() - start
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS, kilobytes elsewhere
+    if sys.platform != 'darwin':
+        rss *= 1024
+    print(json.dumps({'seconds': seconds, 'peak_rss': rss}))
+
+
+def measure(tool, f_name, lines, repeat=1):
+    # best of repeat runs, each in a fresh interpreter
+    best = None
+    for _ in range(repeat):
+        out = subprocess.run([sys.executable, os.path.abspath(__file__), '--run-one', tool, f_name],
+                             check=True, stdout=subprocess.PIPE, universal_newlines=True).stdout
+        result = json.loads(out.splitlines()[-1])
+        if best is None or result['seconds'] < best['seconds']:
+            best = result
+    best['lines'] = lines
+    best['lines_per_sec'] = lines / best['seconds'] if best['seconds'] else 0
+    best['output_bytes'] = os.path.getsize(output_path(f_name))
+    return best
+
+
+def case_name(tool, n):
+    return '%s/%d' % (tool, n)
+
+
+def compare(results, baseline, tolerance):
+    # list of regression messages: throughput down, or peak RSS / output size up,
+    # by more than tolerance relative to the baseline
+    regressions = []
+    for name, case in sorted(results['cases'].items()):
+        base = baseline.get('cases', {}).get(name)
+        if base is None:
+            continue
+        if case['lines_per_sec'] < base['lines_per_sec'] * (1 - tolerance):
+            regressions.append('%s: lines/sec %.0f -> %.0f' % (name, base['lines_per_sec'], case['lines_per_sec']))
+        for key in ('peak_rss', 'output_bytes'):
+            if case[key] > base[key] * (1 + tolerance):
+                regressions.append('%s: %s %d -> %d' % (name, key, base[key], case[key]))
+    return regressions
+
+
+def main(argv):
+    if argv[:1] == ['--run-one']:
+        run_one(argv[1], argv[2])
+        return 0
+    ap = argparse.ArgumentParser(description='Benchmark HackAssembler and VMTranslator on synthetic programs')
+    ap.add_argument('--sizes', default=','.join(map(str, DEFAULT_SIZES)), help='comma separated line counts')
+    ap.add_argument('--tools', default='asm,vm', help='comma separated subset of asm,vm')
+    ap.add_argument('--seed', type=int, default=1)
+    ap.add_argument('--repeat', type=int, default=1, help='runs per case, the fastest is kept')
+    ap.add_argument('-o', '--output', help='write the results JSON here (default stdout)')
+    ap.add_argument('--baseline', help='results JSON to compare against')
+    ap.add_argument('--tolerance', type=float, default=0.10, help='allowed relative slowdown/growth')
+    ap.add_argument('--work-dir', help='keep generated programs here instead of a temporary directory')
+    args = ap.parse_args(argv)
+    sizes = [int(s) for s in args.sizes.split(',')]
+    tools = args.tools.split(',')
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix='hackbench')
+    os.makedirs(work_dir, exist_ok=True)
+    results = {'seed': args.seed, 'python': platform.python_version(), 'machine': platform.machine(),
+               'cases': {}}
+    try:
+        for tool in tools:
+            for n in sizes:
+                f_name = generate(tool, n, args.seed, work_dir)
+                case = measure(tool, f_name, n, args.repeat)
+                results['cases'][case_name(tool, n)] = case
+                print('%-12s %12.0f lines/sec %8.1f MB peak %12d bytes out'
+                      % (case_name(tool, n), case['lines_per_sec'], case['peak_rss'] / 2 ** 20,
+                         case['output_bytes']), file=sys.stderr, flush=True)
+    finally:
+        if not args.work_dir:
+            shutil.rmtree(work_dir, ignore_errors=True)
+    text = json.dumps(results, indent=1, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as outfile:
+            outfile.write(text + '\n')
+    else:
+        print(text)
+    if args.baseline:
+        with open(args.baseline) as infile:
+            regressions = compare(results, json.load(infile), args.tolerance)
+        for line in regressions:
+            print('REGRESSION ' + line, file=sys.stderr)
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
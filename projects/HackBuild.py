@@ -0,0 +1,140 @@
+# Batch driver for the VMTranslator (07) and HackAssembler (06) tools
+# Translates every .vm file and assembles every .asm file found in the given
+# files, directories (searched recursively) or glob patterns, fanning the files
+# out over a process pool so a build pays interpreter start-up only once per worker.
+# Outputs are cached by source content (see HackCache.py): an unchanged file is
+# restored from the cache without running the tool at all.
+
+# Usage: python HackBuild.py [-j WORKERS] [--binary] [--no-cache] [--clear-cache]
+#                            [--cache-dir DIR] [--cache-size MB] PATH|DIR|GLOB ...
+# Prints one line per file as it finishes, then a summary; exits 1 if any file failed.
+
+import argparse
+import glob
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '06'))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '07'))
+import HackAssembler as assembler_module
+import VMTranslator as translator_module
+from HackAssembler import HackAssembler
+from HackCache import BuildCache, DEFAULT_DIR, DEFAULT_MAX_BYTES, file_digest
+from VMTranslator import VMTranslator
+
+SOURCE_EXTS = ('.asm', '.vm')
+
+
+def collect(paths):
+    # expand files, directories and glob patterns into a sorted list of source files
+    found = set()
+    for path in paths:
+        matches = glob.glob(path, recursive=True) if glob.has_magic(path) else [path]
+        for match in matches:
+            if os.path.isdir(match):
+                for root, dirs, files in os.walk(match):
+                    found.update(os.path.join(root, f) for f in files if f.endswith(SOURCE_EXTS))
+            elif match.endswith(SOURCE_EXTS):
+                found.add(match)
+    found = {os.path.abspath(f) for f in found}
+    # a .asm next to a .vm in the same batch is that file's translator output, not a source
+    return sorted(f for f in found
+                  if not (f.endswith('.asm') and os.path.splitext(f)[0] + '.vm' in found))
+
+
+def output_path(f_name, binary=False):
+    # the file the tool writes for f_name, named the same way the tools name it
+    root, ext = os.path.splitext(f_name)
+    if ext == '.vm':
+        return root + '.asm'
+    return root + ('.hackbin' if binary else '.hack')
+
+
+# tool source digests, computed once per worker process
+d_tool_digest = {}
+
+
+def tool_digest(module):
+    if module.__name__ not in d_tool_digest:
+        d_tool_digest[module.__name__] = file_digest(module.__file__)
+    return d_tool_digest[module.__name__]
+
+
+def build_file(f_name, cache_dir=None, binary=False):
+    # worker: run the matching tool on one file (or restore its output from the cache);
+    # returns (f_name, error or None, seconds, cache hit)
+    start = time.perf_counter()
+    hit = False
+    try:
+        is_vm = f_name.endswith('.vm')
+        out_path = output_path(f_name, binary)
+        if cache_dir:
+            cache = BuildCache(cache_dir)
+            with open(f_name, 'rb') as infile:
+                source = infile.read()
+            # statics are named after the file, so a .vm file's output depends on its name
+            options = (('prog_name', os.path.splitext(os.path.basename(f_name))[0]),) if is_vm \
+                else (('binary', binary),)
+            key = cache.key(source, tool_digest(translator_module if is_vm else assembler_module), options)
+            hit = cache.get(key, out_path)
+        if not hit:
+            if is_vm:
+                VMTranslator(f_name)
+            else:
+                HackAssembler(f_name, binary=binary)
+            if cache_dir:
+                cache.put(key, out_path)
+        error = None
+    except Exception as e:
+        error = '%s: %s' % (type(e).__name__, e)
+    return f_name, error, time.perf_counter() - start, hit
+
+
+def build(files, workers=None, cache_dir=None, binary=False):
+    # generator over (f_name, error, seconds, cache hit) in completion order
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = [pool.submit(build_file, f, cache_dir, binary) for f in files]
+        for future in as_completed(futures):
+            yield future.result()
+
+
+def main(argv):
+    ap = argparse.ArgumentParser(description='Translate/assemble many .vm/.asm files in parallel')
+    ap.add_argument('paths', nargs='+', help='files, directories or glob patterns')
+    ap.add_argument('-j', '--workers', type=int, default=os.cpu_count(), help='worker processes')
+    ap.add_argument('--binary', action='store_true', help='assemble to .hackbin instead of .hack')
+    ap.add_argument('--cache-dir', default=DEFAULT_DIR, help='build cache location')
+    ap.add_argument('--cache-size', type=int, default=DEFAULT_MAX_BYTES // 2 ** 20,
+                    help='build cache size cap in MB')
+    ap.add_argument('--no-cache', action='store_true', help='always run the tools')
+    ap.add_argument('--clear-cache', action='store_true', help='invalidate the cache first')
+    args = ap.parse_args(argv)
+    files = collect(args.paths)
+    cache = None if args.no_cache else BuildCache(args.cache_dir, args.cache_size * 2 ** 20)
+    if cache and args.clear_cache:
+        cache.clear()
+    start = time.perf_counter()
+    failed = hits = 0
+    for f_name, error, seconds, hit in build(files, args.workers, cache and cache.cache_dir, args.binary):
+        hits += hit
+        if error:
+            failed += 1
+            print('FAIL %8.3fs  %s  %s' % (seconds, f_name, error), flush=True)
+        else:
+            print('%-4s %8.3fs  %s' % ('hit' if hit else 'ok', seconds, f_name), flush=True)
+    elapsed = time.perf_counter() - start
+    print('%d files, %d failed, %.3fs with %d workers (%.1f files/sec)'
+          % (len(files), failed, elapsed, args.workers, len(files) / elapsed if elapsed else 0))
+    if cache:
+        cache.record(hits, len(files) - failed - hits)
+        evicted = cache.evict()
+        stats = cache.stats()
+        print('cache: %d hits, %d misses this build; %d entries, %d bytes, %d evicted'
+              % (hits, len(files) - failed - hits, stats['entries'], stats['bytes'], evicted))
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
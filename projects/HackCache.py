@@ -0,0 +1,136 @@
+# Content-addressed build cache for HackBuild
+# An entry is keyed by the SHA-256 of the source bytes, the source code of the tool
+# that produced it (so any change to HackAssembler.py / VMTranslator.py invalidates it)
+# and the tool options. Entries are plain files under <cache_dir>/objects; a file's
+# mtime is its last use, and the oldest entries are evicted once the cache grows past
+# its size cap. Hit/miss counters are kept in <cache_dir>/stats.json.
+
+# Usage: python HackCache.py [--cache-dir DIR] stats|clear
+
+import argparse
+import hashlib
+import json
+import os
+import shutil
+import sys
+import tempfile
+
+DEFAULT_DIR = os.environ.get('HACKBUILD_CACHE',
+                             os.path.join(os.path.expanduser('~'), '.cache', 'hackbuild'))
+DEFAULT_MAX_BYTES = 256 * 1024 * 1024
+
+
+def file_digest(f_name):
+    with open(f_name, 'rb') as infile:
+        return hashlib.sha256(infile.read()).hexdigest()
+
+
+class BuildCache:
+    def __init__(self, cache_dir=DEFAULT_DIR, max_bytes=DEFAULT_MAX_BYTES):
+        self.cache_dir = cache_dir
+        self.objects = os.path.join(cache_dir, 'objects')
+        self.max_bytes = max_bytes
+        os.makedirs(self.objects, exist_ok=True)
+
+    def key(self, source, tool_digest, options=()):
+        # source is the raw bytes of the input file, tool_digest identifies the tool version
+        h = hashlib.sha256()
+        h.update(tool_digest.encode())
+        h.update(repr(sorted(options)).encode())
+        h.update(b'\0')
+        h.update(source)
+        return h.hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.objects, key)
+
+    def get(self, key, out_path):
+        # copy a cached output to out_path; returns False on a miss
+        entry = self.path(key)
+        try:
+            shutil.copyfile(entry, out_path)
+        except FileNotFoundError:
+            return False
+        # mark the entry as recently used for LRU eviction
+        os.utime(entry)
+        return True
+
+    def put(self, key, out_path):
+        # store out_path under key; the rename makes concurrent writers safe
+        fd, tmp = tempfile.mkstemp(dir=self.objects)
+        os.close(fd)
+        shutil.copyfile(out_path, tmp)
+        os.replace(tmp, self.path(key))
+
+    def entries(self):
+        # (mtime, size, path) for every cached output
+        result = []
+        for name in os.listdir(self.objects):
+            path = os.path.join(self.objects, name)
+            try:
+                st = os.stat(path)
+            except FileNotFoundError:
+                continue
+            result.append((st.st_mtime, st.st_size, path))
+        return result
+
+    def evict(self):
+        # delete least recently used entries until the cache fits in max_bytes;
+        # returns the number of entries removed
+        entries = sorted(self.entries())
+        total = sum(size for mtime, size, path in entries)
+        removed = 0
+        for mtime, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+            removed += 1
+        return removed
+
+    def clear(self):
+        # invalidate everything, counters included; only the cache's own files are
+        # removed, since cache_dir may be a directory shared with other files
+        shutil.rmtree(self.objects, ignore_errors=True)
+        try:
+            os.remove(os.path.join(self.cache_dir, 'stats.json'))
+        except FileNotFoundError:
+            pass
+        os.makedirs(self.objects, exist_ok=True)
+
+    def stats(self):
+        try:
+            with open(os.path.join(self.cache_dir, 'stats.json')) as infile:
+                stats = json.load(infile)
+        except (FileNotFoundError, ValueError):
+            stats = {'hits': 0, 'misses': 0}
+        entries = self.entries()
+        stats['entries'] = len(entries)
+        stats['bytes'] = sum(size for mtime, size, path in entries)
+        return stats
+
+    def record(self, hits, misses):
+        # add to the persistent hit/miss counters
+        stats = self.stats()
+        stats['hits'] += hits
+        stats['misses'] += misses
+        with open(os.path.join(self.cache_dir, 'stats.json'), 'w') as outfile:
+            json.dump({'hits': stats['hits'], 'misses': stats['misses']}, outfile)
+
+
+def main(argv):
+    ap = argparse.ArgumentParser(description='Inspect or clear the HackBuild cache')
+    ap.add_argument('command', choices=('stats', 'clear'))
+    ap.add_argument('--cache-dir', default=DEFAULT_DIR)
+    args = ap.parse_args(argv)
+    cache = BuildCache(args.cache_dir)
+    if args.command == 'clear':
+        cache.clear()
+    print(json.dumps(cache.stats()))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,108 @@
+# Thin client for HackServer.py
+# Deliberately imports nothing from the tools, so starting it costs no more than the
+# interpreter itself; the work is done by the warm server.
+
+# Usage: python HackClient.py assemble|translate|vm2hack [input|-] [-o out|-] [--socket PATH]
+#                             [--binary] [--fold] [--tos] [--peephole] [--shared] [--shared-arith]
+#                             [--inline-calls] [--no-comments]
+# Reads stdin when no input (or -) is given; an input file without -o writes its output
+# next to it (xxx.hack / xxx.hackbin / xxx.asm), otherwise stdout.
+# From Python, HackClient(path) keeps one connection open for many requests.
+
+import argparse
+import json
+import os
+import socket
+import sys
+import tempfile
+
+DEFAULT_SOCKET = os.environ.get('HACKSERVER_SOCKET',
+                                os.path.join(tempfile.gettempdir(), 'hackserver-%d.sock' % os.getuid()))
+
+
+class HackServerError(Exception):
+    pass
+
+
+class HackClient:
+    def __init__(self, socket_path=DEFAULT_SOCKET):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(socket_path)
+        self.infile = self.sock.makefile('rb')
+
+    def request(self, op, source, **options):
+        # send one request and return the output bytes; raises HackServerError on failure
+        if isinstance(source, str):
+            source = source.encode()
+        header = {'op': op, 'options': options, 'length': len(source)}
+        self.sock.sendall(json.dumps(header).encode() + b'\n' + source)
+        line = self.infile.readline()
+        if not line:
+            raise HackServerError('connection closed by server')
+        reply = json.loads(line)
+        if not reply['ok']:
+            raise HackServerError(reply['error'])
+        return self.infile.read(reply['length'])
+
+    def close(self):
+        self.infile.close()
+        self.sock.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def output_path(f_name, op, binary=False):
+    if op == 'translate':
+        return os.path.splitext(f_name)[0] + '.asm'
+    return os.path.splitext(f_name)[0] + ('.hackbin' if binary else '.hack')
+
+
+def main(argv):
+    ap = argparse.ArgumentParser(description='Send an assembly/translation request to HackServer')
+    ap.add_argument('op', choices=('assemble', 'translate', 'vm2hack'))
+    ap.add_argument('input', nargs='?', default='-', help='source file, or - for stdin')
+    ap.add_argument('-o', '--output', help='output file, or - for stdout')
+    ap.add_argument('--socket', default=DEFAULT_SOCKET)
+    ap.add_argument('--binary', action='store_true', help='packed .hackbin output')
+    for flag in ('fold', 'tos', 'peephole', 'shared'):
+        ap.add_argument('--' + flag, action='store_true')
+    ap.add_argument('--shared-arith', dest='shared_arithmetic', action='store_true')
+    ap.add_argument('--inline-calls', dest='inline_calls', action='store_true')
+    ap.add_argument('--no-comments', dest='comments', action='store_false')
+    args = ap.parse_args(argv)
+    # the server rejects the flags an op does not take
+    options = {flag: True for flag in ('fold', 'tos', 'peephole', 'shared', 'shared_arithmetic', 'inline_calls')
+               if getattr(args, flag)}
+    if not args.comments:
+        options['comments'] = False
+    if args.op != 'assemble' and args.input != '-':
+        options['prog_name'] = os.path.splitext(os.path.basename(args.input))[0]
+    if args.binary:
+        options['binary'] = True
+    if args.input == '-':
+        source = sys.stdin.buffer.read()
+    else:
+        with open(args.input, 'rb') as infile:
+            source = infile.read()
+    output = args.output or ('-' if args.input == '-' else output_path(args.input, args.op, args.binary))
+    try:
+        with HackClient(args.socket) as client:
+            result = client.request(args.op, source, **options)
+    except (OSError, HackServerError) as e:
+        print('error: %s' % e, file=sys.stderr)
+        return 1
+    if output == '-':
+        sys.stdout.buffer.write(result)
+        sys.stdout.flush()
+    else:
+        with open(output, 'wb') as outfile:
+            outfile.write(result)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,264 @@
+# Separate compilation for multi-file VM programs
+# Every .vm file is translated on its own into a relocatable object (xxx.hobj), and the
+# linker combines the objects into one .hack program. Changing one file only means
+# re-translating that file and relinking; the translations run on a process pool.
+
+# Object format (JSON):
+#   name     the file's base name; its statics are the symbols <name>.<index>
+#   text     the file's code section: {"code": [...], "labels": {...}, "relocs": [...]}
+#   lib      shared runtime routines the file calls, one section per routine label;
+#            the linker keeps a single copy of each routine for the whole program
+#   exports  labels in text that other objects may refer to
+#   statics  the file's static symbols in order of first use
+#   tool     digest of the translator and linker sources plus the translation options,
+#            so stale objects are rebuilt after a tool change
+# A section's code has a 0 placeholder for every A-instruction naming a symbol; relocs
+# lists those as [offset, symbol]. labels maps the section's own labels to offsets.
+
+# Linking lays out ROM as: the bootstrap code (SP = 256, call Sys.init) when some object
+# exports Sys.init, every object's text in command-line order, an (END) loop, then the
+# lib routines. Statics get RAM addresses from 16 up, file by file. A symbol
+# resolves to a label of its own section, a static of its own file, another object's
+# export or a lib routine, in that order; anything else is an error.
+
+# Usage: python HackLinker.py [-o xxx.hack] [--binary] [-j WORKERS] [--fold] [--tos]
+#                             [--peephole] [--shared] [--shared-arith] [--inline-calls] FILE.vm|DIR ...
+# Writes xxx.hobj next to every .vm that is new or changed, then links all of them.
+
+import argparse
+import hashlib
+import io
+import json
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '06'))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '07'))
+import HackAssembler
+import VMTranslator
+from HackAssembler import Code, SymbolTable, hack_text, hackbin_bytes
+
+OBJECT_EXT = '.hobj'
+RAM_STATIC_END = 256
+
+
+class LinkError(Exception):
+    pass
+
+
+def assemble_section(source):
+    # relocatable assembly: like HackAssembler.assemble, but symbols that are not labels
+    # of this section are left for the linker instead of becoming variables
+    code, labels, relocs = [], {}, []
+    for inst in HackAssembler.Parser(source).tokenize():
+        if inst.commandType == 'L_COMMAND':
+            labels[inst.symbol] = len(code)
+        elif inst.commandType == 'C_COMMAND':
+            code.append(Code.d_word[(inst.comp, inst.dest, inst.jump)])
+        elif inst.symbol[0].isdigit():
+            code.append(int(inst.symbol))
+        elif inst.symbol in SymbolTable.d_predefined:
+            code.append(SymbolTable.d_predefined[inst.symbol])
+        else:
+            # even the section's own labels are relocated: its base address is not known yet
+            relocs.append([len(code), inst.symbol])
+            code.append(0)
+    return {'code': code, 'labels': labels, 'relocs': relocs}
+
+
+def is_static(name, symbol):
+    prefix = name + '.'
+    return symbol.startswith(prefix) and symbol[len(prefix):].isdigit()
+
+
+def compile_object(text, name, lib=None, exports=()):
+    # build an object from the assembly of one file (text) and its lib routines
+    obj = {'name': name,
+           'text': assemble_section(text),
+           'lib': {label: assemble_section(routine) for label, routine in (lib or {}).items()},
+           'exports': sorted(exports)}
+    statics = []
+    for offset, symbol in obj['text']['relocs']:
+        if is_static(name, symbol) and symbol not in statics:
+            statics.append(symbol)
+    obj['statics'] = statics
+    return obj
+
+
+def translate_object(source, name, fold=False, **options):
+    # VM source (str or an iterable of lines) -> object; options are the CodeWriter flags
+    if isinstance(source, str):
+        source = source.splitlines()
+    outfile = io.StringIO()
+    code_writer = VMTranslator.CodeWriter(name, outfile=outfile, relocatable=True, **options)
+    for _ in VMTranslator.translate_commands(VMTranslator.Parser(source), code_writer, fold):
+        pass
+    return compile_object(outfile.getvalue(), name, code_writer.lib, code_writer.exports)
+
+
+def bootstrap_object():
+    # SP = 256, call Sys.init; its call routines come with it in lib
+    outfile = io.StringIO()
+    code_writer = VMTranslator.CodeWriter('__bootstrap', outfile=outfile, comments=False, relocatable=True)
+    code_writer.write_init()
+    code_writer.close()
+    return compile_object(outfile.getvalue(), '__bootstrap', code_writer.lib)
+
+
+def tool_digest(options):
+    h = hashlib.sha256()
+    for module in (HackAssembler, VMTranslator, sys.modules[__name__]):
+        with open(module.__file__, 'rb') as infile:
+            h.update(infile.read())
+    h.update(repr(sorted(options.items())).encode())
+    return h.hexdigest()
+
+
+def write_object(f_name, obj):
+    with open(f_name, 'w') as outfile:
+        json.dump(obj, outfile, separators=(',', ':'))
+
+
+def load_object(f_name):
+    with open(f_name, 'r') as infile:
+        return json.load(infile)
+
+
+def link(objects, symbols=None):
+    # objects in ROM order -> list of instruction words; symbols, if given, receives
+    # every export, lib routine and static address the linker assigned
+    if symbols is None:
+        symbols = {}
+    if any('Sys.init' in obj['exports'] for obj in objects):
+        objects = [bootstrap_object()] + list(objects)
+    layout = []
+    addresses = {}
+    addr = 0
+    for obj in objects:
+        layout.append((obj, obj['text'], addr))
+        for label in obj['exports']:
+            if label in addresses:
+                raise LinkError('%s: %s is already exported by another object' % (obj['name'], label))
+            addresses[label] = addr + obj['text']['labels'][label]
+        addr += len(obj['text']['code'])
+    end = addr
+    addr += 2
+    for obj in objects:
+        for label, section in sorted(obj['lib'].items()):
+            if label not in addresses:
+                layout.append((obj, section, addr))
+                addresses[label] = addr + section['labels'][label]
+                addr += len(section['code'])
+    statics = {}
+    for obj in objects:
+        for symbol in obj['statics']:
+            statics[symbol] = 16 + len(statics)
+    if 16 + len(statics) > RAM_STATIC_END:
+        raise LinkError('%d statics do not fit in RAM[16..255]' % len(statics))
+    words = [0] * addr
+    # (END) loop after the last file's code
+    words[end:end + 2] = (end, Code.d_word[('0', None, 'JMP')])
+    for obj, section, base in layout:
+        code = section['code']
+        words[base:base + len(code)] = code
+        for offset, symbol in section['relocs']:
+            if symbol in section['labels']:
+                words[base + offset] = base + section['labels'][symbol]
+            elif is_static(obj['name'], symbol):
+                words[base + offset] = statics[symbol]
+            elif symbol in addresses:
+                words[base + offset] = addresses[symbol]
+            else:
+                raise LinkError('%s: undefined symbol %s' % (obj['name'], symbol))
+    symbols.update(addresses)
+    symbols.update(statics)
+    return words
+
+
+def collect(paths):
+    # .vm files in command-line order, directories expanded in sorted order
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files.extend(sorted(os.path.join(path, f) for f in os.listdir(path) if f.endswith('.vm')))
+        else:
+            files.append(path)
+    return files
+
+
+def object_path(f_name):
+    return os.path.splitext(f_name)[0] + OBJECT_EXT
+
+
+def compile_file(f_name, options):
+    # worker: translate one .vm file and write its object
+    name = os.path.splitext(os.path.basename(f_name))[0]
+    options = dict(options)
+    fold = options.pop('fold', False)
+    with open(f_name, 'r') as infile:
+        obj = translate_object(infile, name, fold, **options)
+    obj['tool'] = tool_digest(dict(options, fold=fold))
+    write_object(object_path(f_name), obj)
+    return f_name
+
+
+def stale(f_name, digest):
+    # True if the object for f_name is missing, older than the source or built differently
+    path = object_path(f_name)
+    try:
+        if os.path.getmtime(path) < os.path.getmtime(f_name):
+            return True
+        return load_object(path).get('tool') != digest
+    except (OSError, ValueError):
+        return True
+
+
+def build(files, options, workers=None):
+    # compile the stale objects in parallel; returns the names of the files compiled
+    digest = tool_digest(options)
+    todo = [f for f in files if stale(f, digest)]
+    if len(todo) > 1:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            list(pool.map(compile_file, todo, [options] * len(todo)))
+    elif todo:
+        compile_file(todo[0], options)
+    return todo
+
+
+def main(argv):
+    ap = argparse.ArgumentParser(description='Translate .vm files to objects and link them into one program')
+    ap.add_argument('paths', nargs='+', help='.vm files or directories of .vm files')
+    ap.add_argument('-o', '--output', help='program file (default: named after the directory or first file)')
+    ap.add_argument('--binary', action='store_true', help='packed .hackbin output')
+    ap.add_argument('-j', '--workers', type=int, default=os.cpu_count(), help='translation worker processes')
+    for flag in ('fold', 'tos', 'peephole', 'shared'):
+        ap.add_argument('--' + flag, action='store_true')
+    ap.add_argument('--shared-arith', dest='shared_arithmetic', action='store_true')
+    ap.add_argument('--inline-calls', dest='inline_calls', action='store_true')
+    args = ap.parse_args(argv)
+    options = dict(fold=args.fold, tos=args.tos, peephole=args.peephole, shared=args.shared,
+                   shared_arithmetic=args.shared_arithmetic, inline_calls=args.inline_calls)
+    files = collect(args.paths)
+    if not files:
+        print('no .vm files found', file=sys.stderr)
+        return 1
+    output = args.output
+    if output is None:
+        first = args.paths[0].rstrip(os.sep)
+        root = os.path.join(first, os.path.basename(first)) if os.path.isdir(first) else os.path.splitext(first)[0]
+        output = root + ('.hackbin' if args.binary else '.hack')
+    compiled = build(files, options, args.workers)
+    try:
+        words = link([load_object(object_path(f)) for f in files])
+    except LinkError as e:
+        print('link error: %s' % e, file=sys.stderr)
+        return 1
+    with open(output, 'wb') as outfile:
+        outfile.write(hackbin_bytes(words) if args.binary else hack_text(words).encode())
+    print('%d files, %d translated, %d words -> %s' % (len(files), len(compiled), len(words), output))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
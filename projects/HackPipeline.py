@@ -0,0 +1,63 @@
+# In-process VM -> ASM -> HACK pipeline
+# The VMTranslator's CodeWriter output is streamed line by line straight into the
+# one-pass assembler (HackAssembler.assemble_stream), so no .asm file is written or
+# read back and the whole program's text is never held in memory; each line is still
+# parsed once by the assembler's Parser.
+
+# Usage: python HackPipeline.py [xxx.vm|-] [-o xxx.hack|-] [--binary] [--fold] [--tos] [--peephole]
+#                               [--shared] [--shared-arith] [--inline-calls]
+# Reads stdin when no input (or -) is given; writes stdout unless -o names a file
+# (an input file without -o writes xxx.hack / xxx.hackbin next to it).
+
+import argparse
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '06'))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '07'))
+from HackAssembler import assemble_stream, hack_text, hackbin_bytes
+from VMTranslator import translate_lines
+
+
+def vm_to_hack(lines, prog_name="Main", fold=False, **options):
+    # VM source lines in, list of 16-bit instruction words out
+    return assemble_stream(translate_lines(lines, prog_name, fold=fold, **options))
+
+
+def write_words(outfile, words, binary=False):
+    # outfile is a binary stream; text .hack or packed little-endian .hackbin
+    outfile.write(hackbin_bytes(words) if binary else hack_text(words).encode())
+
+
+def main(argv):
+    ap = argparse.ArgumentParser(description='Translate a .vm program straight to Hack machine code')
+    ap.add_argument('input', nargs='?', default='-', help='.vm file, or - for stdin')
+    ap.add_argument('-o', '--output', help='output file, or - for stdout')
+    ap.add_argument('--binary', action='store_true', help='packed .hackbin output')
+    for flag in ('fold', 'tos', 'peephole', 'shared'):
+        ap.add_argument('--' + flag, action='store_true')
+    ap.add_argument('--shared-arith', dest='shared_arithmetic', action='store_true')
+    ap.add_argument('--inline-calls', dest='inline_calls', action='store_true')
+    args = ap.parse_args(argv)
+    options = dict(fold=args.fold, tos=args.tos, peephole=args.peephole, shared=args.shared,
+                   shared_arithmetic=args.shared_arithmetic, inline_calls=args.inline_calls)
+    output = args.output
+    if output is None:
+        output = '-' if args.input == '-' else \
+            os.path.splitext(args.input)[0] + ('.hackbin' if args.binary else '.hack')
+    prog_name = 'Main' if args.input == '-' else os.path.splitext(os.path.basename(args.input))[0]
+    if args.input == '-':
+        words = vm_to_hack(sys.stdin, prog_name, **options)
+    else:
+        with open(args.input, 'r') as infile:
+            words = vm_to_hack(infile, prog_name, **options)
+    if output == '-':
+        write_words(sys.stdout.buffer, words, args.binary)
+        sys.stdout.flush()
+    else:
+        with open(output, 'wb') as outfile:
+            write_words(outfile, words, args.binary)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,198 @@
+# Counting profiler for Hack programs
+# Runs a .hack/.hackbin program on the HackEmulator interpreter and counts the cycles
+# spent at every ROM address under every VM call stack. With the source maps written by
+# HackAssembler.py --map (xxx.hackmap: ROM address -> .asm line) and VMTranslator.py
+# --map (xxx.vmmap: .asm line -> .vm file/line/command) the cycles are attributed to VM
+# commands and functions; without them to .asm lines or ROM addresses.
+
+# Call stacks are tracked from the machine state: arriving at a function's entry address
+# with LCL == SP (both the shared and the inline call sequences set LCL = SP right before
+# jumping) enters a new frame, and LCL dropping below a frame's LCL means it returned.
+
+# Usage: python HackProfile.py xxx.hack [--cycles N] [--ram ADDR=VALUE ...] [--top N]
+#                              [--collapsed out.folded] [--no-commands]
+# Prints the hottest VM commands and functions; --collapsed writes one
+# "root;caller;callee;command cycles" line per stack, the input flamegraph.pl and
+# speedscope accept. --no-commands stops the stacks at the function level.
+
+import argparse
+import json
+import os
+import sys
+from bisect import bisect_right
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '06'))
+from HackEmulator import A_INST, C_INST, DEST_A, DEST_D, DEST_M, HackEmulator, parse_ram
+
+
+class SourceMap:
+    # ROM address -> .asm line -> .vm region
+    def __init__(self, asm_name=None, rom_lines=None, regions=None):
+        self.asm_name = asm_name
+        self.rom_lines = rom_lines
+        self.regions = regions or []
+        self.starts = [region[0] for region in self.regions]
+
+    @classmethod
+    def load(cls, program):
+        # read xxx.hackmap and the .vmmap of the .asm it names, if they exist
+        try:
+            with open(os.path.splitext(program)[0] + '.hackmap') as infile:
+                hackmap = json.load(infile)
+        except FileNotFoundError:
+            return cls()
+        vmmap = os.path.join(os.path.dirname(program), os.path.splitext(hackmap['asm'])[0] + '.vmmap')
+        try:
+            with open(vmmap) as infile:
+                regions = json.load(infile)['regions']
+        except FileNotFoundError:
+            regions = None
+        return cls(hackmap['asm'], hackmap['lines'], regions)
+
+    def region(self, addr):
+        # the [asm_line, vm_file, vm_line, command, function] region addr came from
+        if not self.rom_lines or addr >= len(self.rom_lines) or not self.regions:
+            return None
+        i = bisect_right(self.starts, self.rom_lines[addr]) - 1
+        return self.regions[i] if i >= 0 else None
+
+    def describe(self, addr):
+        region = self.region(addr)
+        if region is not None:
+            if region[1]:
+                return '%s:%d %s' % (region[1], region[2], region[3])
+            return region[3]
+        if self.rom_lines and addr < len(self.rom_lines):
+            return '%s:%d' % (self.asm_name, self.rom_lines[addr])
+        return 'rom:%d' % addr
+
+    def command_starts(self):
+        # ROM addresses where the code of a VM command begins
+        starts = set()
+        for region in self.regions:
+            if region[1]:
+                addr = bisect_right(self.rom_lines, region[0])
+                if addr < len(self.rom_lines):
+                    starts.add(addr)
+        return starts
+
+    def function_entries(self):
+        # ROM address of the first instruction of every function
+        entries = {}
+        for region in self.regions:
+            if region[1] and region[3].startswith('function '):
+                addr = bisect_right(self.rom_lines, region[0])
+                if addr < len(self.rom_lines):
+                    entries[addr] = region[4]
+        return entries
+
+
+def profile(emulator, entries, max_cycles=10 ** 8):
+    # run like HackEmulator.run, counting cycles per ROM address under each call stack;
+    # entries maps function entry addresses to names. Returns {stack tuple: {addr: cycles}}
+    prog, ram = emulator.prog, emulator.ram
+    pc, a, d = emulator.pc, emulator.a, emulator.d
+    stack = ()
+    frames = []
+    counts = {stack: {}}
+    current = counts[stack]
+    n = 0
+    while n < max_cycles:
+        kind, value, comp, dest, jump = prog[pc]
+        current[pc] = current.get(pc, 0) + 1
+        if kind == A_INST:
+            a = value
+            pc += 1
+        elif kind == C_INST:
+            out = comp(a, d, ram[a & 0x7FFF])
+            if dest:
+                if dest & DEST_M:
+                    ram[a & 0x7FFF] = out
+                if dest & DEST_D:
+                    d = out
+                if dest & DEST_A:
+                    a = out
+            if jump and jump & (4 if out < 0 else 2 if out == 0 else 1):
+                pc = a & 0x7FFF
+            else:
+                pc += 1
+        else:
+            # the HALT entry was counted above but is not an executed cycle
+            current[pc] -= 1
+            if not current[pc]:
+                del current[pc]
+            emulator.halted = True
+            break
+        n += 1
+        changed = False
+        while frames and ram[1] < frames[-1]:
+            frames.pop()
+            stack = stack[:-1]
+            changed = True
+        if pc in entries and ram[1] == ram[0] and (not frames or frames[-1] != ram[1]):
+            frames.append(ram[1])
+            stack = stack + (entries[pc],)
+            changed = True
+        if changed:
+            current = counts.setdefault(stack, {})
+    emulator.pc, emulator.a, emulator.d = pc, a, d
+    emulator.cycles += n
+    return counts
+
+
+def collapse(counts, source_map, root, commands=True):
+    # {"root;f;g;leaf": cycles} in the folded-stack format
+    folded = {}
+    for stack, addrs in counts.items():
+        prefix = ';'.join((root,) + stack)
+        for addr, cycles in addrs.items():
+            key = prefix + ';' + source_map.describe(addr) if commands else prefix
+            folded[key] = folded.get(key, 0) + cycles
+    return folded
+
+
+def main(argv):
+    ap = argparse.ArgumentParser(description='Attribute the cycles of a Hack program to VM commands and functions')
+    ap.add_argument('program')
+    ap.add_argument('--cycles', type=int, default=10 ** 8, help='cycle budget')
+    ap.add_argument('--ram', action='append', default=[], metavar='ADDR=VALUE',
+                    help='initial RAM value, may be repeated')
+    ap.add_argument('--top', type=int, default=15, help='entries in the printed reports')
+    ap.add_argument('--collapsed', help='write collapsed stacks here')
+    ap.add_argument('--no-commands', dest='commands', action='store_false',
+                    help='collapsed stacks end at the function, not the VM command')
+    args = ap.parse_args(argv)
+    emulator = HackEmulator.load(args.program)
+    for addr, value in parse_ram(args.ram):
+        emulator.ram[addr] = value
+    source_map = SourceMap.load(args.program)
+    counts = profile(emulator, source_map.function_entries(), args.cycles)
+    root = os.path.splitext(os.path.basename(args.program))[0]
+    total = emulator.cycles
+    print('cycles: ', total, 'halted' if emulator.halted else 'budget exhausted')
+    by_command = {}
+    self_cycles = {}
+    total_cycles = {root: total}
+    for stack, addrs in counts.items():
+        cycles = sum(addrs.values())
+        function = stack[-1] if stack else root
+        self_cycles[function] = self_cycles.get(function, 0) + cycles
+        for function in set(stack):
+            total_cycles[function] = total_cycles.get(function, 0) + cycles
+        for addr, n in addrs.items():
+            key = source_map.describe(addr)
+            by_command[key] = by_command.get(key, 0) + n
+    print('\n%10s %6s  %s' % ('cycles', '%', 'command'))
+    for key, n in sorted(by_command.items(), key=lambda kv: -kv[1])[:args.top]:
+        print('%10d %6.2f  %s' % (n, 100.0 * n / total if total else 0, key))
+    print('\n%10s %10s  %s' % ('self', 'total', 'function'))
+    for function, n in sorted(self_cycles.items(), key=lambda kv: -kv[1])[:args.top]:
+        print('%10d %10d  %s' % (n, total_cycles.get(function, n), function))
+    if args.collapsed:
+        with open(args.collapsed, 'w') as outfile:
+            for key, n in sorted(collapse(counts, source_map, root, args.commands).items()):
+                outfile.write('%s %d\n' % (key, n))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
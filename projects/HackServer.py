@@ -0,0 +1,156 @@
+# Persistent assembler/translator daemon on a Unix domain socket
+# Keeps HackAssembler and VMTranslator imported and warm so a build step pays a socket
+# round trip per file instead of an interpreter start-up. Clients connect with
+# HackClient.py (or HackClient.request from Python) and may send any number of requests
+# over one connection; connections are served concurrently by asyncio.
+# Small sources are handled inline on the event loop, which keeps their latency well
+# under a millisecond; sources of --inline-bytes or more go to a process pool so large
+# jobs run in parallel and never stall the other clients.
+
+# Protocol, per request: one JSON header line {"op": ..., "options": {...}, "length": N}
+# followed by N bytes of source. ops: assemble (.asm -> .hack, or .hackbin with
+# options.binary), translate (.vm -> .asm, options are the CodeWriter flags plus fold),
+# vm2hack (.vm -> .hack/.hackbin in one step). An option the op does not take is an error.
+# Reply: one JSON header line {"ok": true, "length": N} followed by N bytes of output,
+# or {"ok": false, "error": "..."} with no payload. A header without a valid length
+# cannot be framed, so the server replies with an error and closes the connection.
+
+# Usage: python HackServer.py [--socket PATH] [-j WORKERS] [--inline-bytes N]
+
+import argparse
+import asyncio
+import json
+import os
+import signal
+import sys
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '06'))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '07'))
+from HackAssembler import assemble, assemble_stream, hack_text, hackbin_bytes
+from VMTranslator import translate, translate_lines
+
+DEFAULT_SOCKET = os.environ.get('HACKSERVER_SOCKET',
+                                os.path.join(tempfile.gettempdir(), 'hackserver-%d.sock' % os.getuid()))
+DEFAULT_INLINE_BYTES = 16384
+
+TRANSLATE_OPTIONS = ('fold', 'peephole', 'shared', 'shared_arithmetic', 'tos', 'comments', 'inline_calls')
+# op -> the options it accepts
+OP_OPTIONS = {
+    'assemble': ('binary',),
+    'translate': ('prog_name',) + TRANSLATE_OPTIONS,
+    'vm2hack': ('binary', 'prog_name') + TRANSLATE_OPTIONS,
+}
+
+
+def encode(words, binary=False):
+    return hackbin_bytes(words) if binary else hack_text(words).encode()
+
+
+def handle(op, source, options):
+    # run one request; source is bytes, the result is the output bytes.
+    # A module-level function so it can run in the pool workers as well as inline.
+    if op not in OP_OPTIONS:
+        raise ValueError('unknown op: %s' % op)
+    unknown = set(options) - set(OP_OPTIONS[op])
+    if unknown:
+        raise ValueError('options not valid for %s: %s' % (op, ', '.join(sorted(unknown))))
+    options = dict(options)
+    binary = options.pop('binary', False)
+    prog_name = options.pop('prog_name', 'Main')
+    if op == 'assemble':
+        return encode(assemble(source), binary)
+    if op == 'translate':
+        return translate(source, prog_name, **options).encode()
+    return encode(assemble_stream(translate_lines(source.decode().splitlines(), prog_name, **options)), binary)
+
+
+class HackServer:
+    def __init__(self, socket_path=DEFAULT_SOCKET, workers=None, inline_bytes=DEFAULT_INLINE_BYTES):
+        self.socket_path = socket_path
+        self.inline_bytes = inline_bytes
+        self.pool = ProcessPoolExecutor(max_workers=workers)
+        self.requests = 0
+        self.errors = 0
+
+    async def run_request(self, op, source, options):
+        if len(source) < self.inline_bytes:
+            return handle(op, source, options)
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.pool, handle, op, source, options)
+
+    async def client(self, reader, writer):
+        # serve requests on one connection until the client closes it
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                try:
+                    header = json.loads(line)
+                except ValueError:
+                    header = None
+                length = header.get('length') if isinstance(header, dict) else None
+                if type(length) is not int or length < 0:
+                    # no way to find the next request: report it and drop the connection
+                    self.errors += 1
+                    self.requests += 1
+                    writer.write(json.dumps({'ok': False, 'error': 'bad request header: no valid length'}).encode()
+                                 + b'\n')
+                    await writer.drain()
+                    break
+                try:
+                    source = await reader.readexactly(length)
+                except asyncio.IncompleteReadError:
+                    break
+                try:
+                    if 'op' not in header:
+                        raise ValueError('request has no op')
+                    options = header.get('options', {})
+                    if not isinstance(options, dict):
+                        raise ValueError('options must be an object')
+                    output = await self.run_request(header['op'], source, options)
+                    reply = {'ok': True, 'length': len(output)}
+                except Exception as e:
+                    output = b''
+                    reply = {'ok': False, 'error': '%s: %s' % (type(e).__name__, e)}
+                    self.errors += 1
+                self.requests += 1
+                writer.write(json.dumps(reply).encode() + b'\n' + output)
+                await writer.drain()
+        except ConnectionResetError:
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self):
+        if os.path.exists(self.socket_path):
+            os.remove(self.socket_path)
+        server = await asyncio.start_unix_server(self.client, path=self.socket_path)
+        loop = asyncio.get_running_loop()
+        stop = loop.create_future()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(sig, stop.set_result, None)
+        print('listening on %s' % self.socket_path, file=sys.stderr, flush=True)
+        try:
+            async with server:
+                await stop
+        finally:
+            os.remove(self.socket_path)
+            self.pool.shutdown()
+            print('served %d requests, %d errors' % (self.requests, self.errors), file=sys.stderr)
+
+
+def main(argv):
+    ap = argparse.ArgumentParser(description='Serve HackAssembler/VMTranslator requests on a Unix socket')
+    ap.add_argument('--socket', default=DEFAULT_SOCKET, help='socket path')
+    ap.add_argument('-j', '--workers', type=int, default=os.cpu_count(), help='pool worker processes')
+    ap.add_argument('--inline-bytes', type=int, default=DEFAULT_INLINE_BYTES,
+                    help='sources smaller than this are handled on the event loop')
+    args = ap.parse_args(argv)
+    asyncio.run(HackServer(args.socket, args.workers, args.inline_bytes).serve())
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,406 @@
+# Runner for nand2tetris .tst test scripts and their .cmp comparison tables
+# Interprets the CPU/VM emulator script subset in-process on HackEmulator, so a whole
+# regression suite runs without the external emulators; scripts are spread over a
+# process pool and reported one line each with their cycle count and wall time.
+
+# Supported commands: load, output-file, compare-to, output-list, set, repeat {...},
+# ticktock/tock (one instruction), tick (no-op), vmstep, output, echo.
+# Variables: RAM[i], A, D, PC, time, sp/local/argument/this/that, local[i]/argument[i]/
+# this[i]/that[i], temp[i], static[i]. Output formats are %B, %X, %D and %S with the
+# usual padLeft.length.padRight widths.
+
+# Programs are rebuilt from source by default, so the tools are what is tested:
+#   load xxx.hack  assembles xxx.asm if it exists
+#   load xxx.asm   translates xxx.vm, or the directory xxx when its .vm files are the source
+#   load xxx.vm / load DIR / load   translates the .vm files without the bootstrap code;
+#                  like the VM emulator, execution starts at Sys.init when there is one
+# --no-build loads .hack/.asm files as they are. vmstep runs to the start of the next VM
+# command, taken from the translator's source map; commands that emit no code (labels)
+# do not count as a step.
+
+# Comparison is per |-separated cell and ignores whitespace; a cell of '*' in the .cmp
+# matches anything. A script stops at its first mismatch. Scripts that load chips (.hdl)
+# or use other commands are reported as SKIP.
+
+# Usage: python HackTest.py [-j WORKERS] [--cycles N] [--no-build] [--peephole] [--shared]
+#                           [--shared-arith] [--fold] [--tos] [--inline-calls] FILE.tst|DIR ...
+# Directories are searched recursively for .tst files. Exits 1 if any script failed.
+
+import argparse
+import io
+import os
+import re
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, '06'))
+sys.path.insert(0, os.path.join(HERE, '07'))
+from HackAssembler import Parser as AsmParser, SymbolTable, first_pass, rom_lines, second_pass
+from HackEmulator import HackEmulator, load_rom
+from HackProfile import SourceMap
+from VMTranslator import program_files, translate_files
+
+
+class ScriptError(Exception):
+    # the script is malformed, or the program misbehaved under it
+    pass
+
+
+class Unsupported(Exception):
+    # the script needs something outside the supported subset
+    pass
+
+
+class Mismatch(Exception):
+    pass
+
+
+# comments, and the strings of echo commands, which may hold separators
+r_comments = re.compile(r'//[^\n]*|/\*.*?\*/|"[^"]*"', re.S)
+r_format = re.compile(r'^(.+?)%([BXDS])(\d+)\.(\d+)\.(\d+)$')
+r_variable = re.compile(r'^([A-Za-z]+)(?:\[(\d+)\])?$')
+
+SEGMENT_POINTERS = {'sp': 0, 'local': 1, 'argument': 2, 'this': 3, 'that': 4}
+
+# commands that need a loaded program
+MACHINE_COMMANDS = ('repeat', 'set', 'ticktock', 'tock', 'tick', 'vmstep', 'output')
+
+
+def parse_script(text):
+    # .tst source -> nested command list; a command is a list of words, a repeat
+    # block is ['repeat', count or None, [commands]]
+    tokens = [t.strip() for t in re.split(r'([,;{}])', r_comments.sub('', text))]
+    stack = [[]]
+    for token in tokens:
+        if not token or token in ',;':
+            continue
+        if token == '{':
+            head = stack[-1].pop() if stack[-1] else None
+            if not head or head[0] != 'repeat':
+                raise Unsupported('block command %s' % (head[0] if head else '?'))
+            block = ['repeat', int(head[1]) if len(head) > 1 else None, []]
+            stack[-1].append(block)
+            stack.append(block[2])
+        elif token == '}':
+            if len(stack) == 1:
+                raise ScriptError('unbalanced }')
+            stack.pop()
+        else:
+            stack[-1].append(token.split())
+    if len(stack) != 1:
+        raise ScriptError('unbalanced {')
+    return stack[0]
+
+
+def parse_value(text):
+    # %X/%B/%D prefixed or plain decimal, as a signed 16-bit value
+    base = {'%X': 16, '%B': 2, '%D': 10}.get(text[:2].upper())
+    value = int(text[2:], base) if base else int(text)
+    return ((value + 0x8000) & 0xFFFF) - 0x8000
+
+
+def format_value(value, kind):
+    if kind == 'B':
+        return format(value & 0xFFFF, '016b')
+    if kind == 'X':
+        return format(value & 0xFFFF, '04X')
+    return str(value)
+
+
+def cells(line):
+    return [cell.strip() for cell in line.strip().strip('|').split('|')]
+
+
+def cells_match(out, cmp):
+    a, b = cells(out), cells(cmp)
+    if len(a) != len(b):
+        return False
+    return all(y == x or (y and set(y) == {'*'}) for x, y in zip(a, b))
+
+
+def assemble_text(text):
+    # (words, rom_lines, symbol_table) for assembly source text
+    symbol_table = SymbolTable()
+    instructions = AsmParser(text).tokenize()
+    first_pass(instructions, symbol_table)
+    return second_pass(instructions, symbol_table), rom_lines(instructions), symbol_table
+
+
+class TestScript:
+    def __init__(self, f_name, build=True, max_cycles=10 ** 8, options=None):
+        self.f_name = f_name
+        self.dir = os.path.dirname(os.path.abspath(f_name))
+        self.build = build
+        self.max_cycles = max_cycles
+        self.options = options or {}
+        self.emulator = None
+        self.symbols = {}
+        self.starts = None
+        self.outfile = None
+        self.cmp_lines = None
+        self.output_list = None
+        self.line_no = 0
+
+    def path(self, name):
+        return os.path.join(self.dir, name)
+
+    def run(self):
+        with open(self.f_name, 'r') as infile:
+            commands = parse_script(infile.read())
+        try:
+            self.execute(commands)
+        finally:
+            if self.outfile is not None:
+                self.outfile.close()
+        if self.cmp_lines is not None and self.line_no < len(self.cmp_lines):
+            raise Mismatch('output ended at line %d of %d' % (self.line_no, len(self.cmp_lines)))
+
+    def execute(self, commands):
+        for command in commands:
+            if command[0] in MACHINE_COMMANDS and self.emulator is None:
+                raise ScriptError('%s before load' % command[0])
+            if command[0] == 'repeat':
+                self.repeat(command[1], command[2])
+                continue
+            name, args = command[0], command[1:]
+            if name == 'load':
+                self.load(args[0] if args else None)
+            elif name == 'output-file':
+                self.outfile = open(self.path(args[0]), 'w')
+            elif name == 'compare-to':
+                with open(self.path(args[0]), 'r') as infile:
+                    self.cmp_lines = [line for line in infile.read().splitlines() if line.strip()]
+            elif name == 'output-list':
+                # the reference emulators write the header as soon as the list is set
+                self.output_list = [self.output_item(arg) for arg in args]
+                self.emit('|' + '|'.join(label[:left + width + right].center(left + width + right)
+                                         for label, _, _, _, left, width, right in self.output_list) + '|')
+            elif name == 'set':
+                self.set(args[0], parse_value(args[1]))
+            elif name in ('ticktock', 'tock'):
+                self.step(1)
+            elif name == 'tick':
+                pass
+            elif name == 'vmstep':
+                self.vmstep()
+            elif name == 'output':
+                self.output()
+            elif name == 'echo':
+                pass
+            else:
+                raise Unsupported('command %s' % name)
+
+    def repeat(self, count, body):
+        # a body of only ticktocks runs as one emulator call
+        if all(command[0] in ('ticktock', 'tock', 'tick') for command in body):
+            per = sum(command[0] != 'tick' for command in body)
+            self.step(per * count if count is not None else self.max_cycles)
+            return
+        n = 0
+        while count is None or n < count:
+            self.execute(body)
+            n += 1
+            if self.emulator.halted or self.emulator.cycles >= self.max_cycles:
+                break
+
+    def load(self, name):
+        if name is not None and name.endswith('.hdl'):
+            raise Unsupported('chip %s' % name)
+        target = self.dir if name is None else self.path(name)
+        self.starts = None
+        root, ext = os.path.splitext(target)
+        if os.path.isdir(target) or ext == '.vm':
+            self.load_vm(target, start=True)
+        elif ext in ('.hack', '.hackbin'):
+            if self.build and os.path.exists(root + '.asm'):
+                self.load_asm(root + '.asm')
+            else:
+                self.emulator = HackEmulator(load_rom(target))
+        elif ext == '.asm':
+            self.load_asm(target)
+        else:
+            raise Unsupported('load %s' % name)
+
+    def load_asm(self, f_name):
+        root = os.path.splitext(f_name)[0]
+        source = os.path.dirname(root)
+        if self.build and os.path.exists(root + '.vm'):
+            return self.load_vm(root + '.vm', start=False)
+        if self.build and os.path.basename(source) == os.path.basename(root) and program_files(source)[0]:
+            return self.load_vm(source, start=False)
+        with open(f_name, 'r') as infile:
+            words, lines, symbol_table = assemble_text(infile.read())
+        self.emulator = HackEmulator(words)
+        self.symbols = symbol_table.d_symbol
+
+    def load_vm(self, f_name, start):
+        # translate a .vm file or directory; start: VM emulator semantics (no bootstrap,
+        # begin at Sys.init), otherwise the program as VMTranslator.py would write it
+        files, prog_name, bootstrap = program_files(f_name)
+        if not files:
+            raise ScriptError('no .vm files in %s' % f_name)
+        outfile = io.StringIO()
+        code_writer = translate_files(files, prog_name, outfile, bootstrap=bootstrap and not start,
+                                      source_map=True, **self.options)
+        words, lines, symbol_table = assemble_text(outfile.getvalue())
+        self.emulator = HackEmulator(words)
+        self.symbols = symbol_table.d_symbol
+        self.starts = SourceMap(None, lines, code_writer.source_map.regions).command_starts()
+        if start and 'Sys.init' in self.symbols:
+            self.emulator.pc = self.symbols['Sys.init']
+
+    def step(self, n):
+        self.emulator.run(min(n, self.max_cycles - self.emulator.cycles))
+
+    def vmstep(self):
+        if self.starts is None:
+            raise ScriptError('vmstep needs a .vm program')
+        emulator = self.emulator
+        while emulator.cycles < self.max_cycles:
+            if not emulator.run(1) or emulator.pc in self.starts:
+                break
+
+    def address(self, name, index):
+        # RAM address of a variable, or None for a register
+        ram = self.emulator.ram
+        if name == 'RAM':
+            return index
+        if name in SEGMENT_POINTERS:
+            pointer = SEGMENT_POINTERS[name]
+            return pointer if index is None else ram[pointer] + index
+        if name == 'temp':
+            return 5 + index
+        if name == 'static':
+            return 16 + index
+        if name in ('A', 'D', 'PC', 'time'):
+            return None
+        raise Unsupported('variable %s' % name)
+
+    def variable(self, text):
+        match = r_variable.match(text)
+        if match is None:
+            raise ScriptError('bad variable %s' % text)
+        name, index = match.group(1), match.group(2)
+        if name in ('RAM', 'temp', 'static') and index is None:
+            raise ScriptError('%s needs an index' % name)
+        return name, None if index is None else int(index)
+
+    def get(self, name, index):
+        addr = self.address(name, index)
+        if addr is not None:
+            return self.emulator.ram[addr & 0x7FFF]
+        return {'A': self.emulator.a, 'D': self.emulator.d, 'PC': self.emulator.pc,
+                'time': self.emulator.cycles}[name]
+
+    def set(self, text, value):
+        name, index = self.variable(text)
+        addr = self.address(name, index)
+        if addr is not None:
+            self.emulator.ram[addr & 0x7FFF] = value
+        elif name == 'A':
+            self.emulator.a = value
+        elif name == 'D':
+            self.emulator.d = value
+        elif name == 'PC':
+            self.emulator.pc = value & 0x7FFF
+            self.emulator.halted = False
+        else:
+            raise ScriptError('cannot set %s' % name)
+
+    def output_item(self, arg):
+        match = r_format.match(arg)
+        if match is None:
+            raise ScriptError('bad output-list item %s' % arg)
+        name, index = self.variable(match.group(1))
+        return (match.group(1), name, index, match.group(2),
+                int(match.group(3)), int(match.group(4)), int(match.group(5)))
+
+    def output(self):
+        if self.output_list is None:
+            raise ScriptError('output before output-list')
+        row = []
+        for _, name, index, kind, left, width, right in self.output_list:
+            text = format_value(self.get(name, index), kind)
+            text = text.ljust(width) if kind == 'S' else text.rjust(width)
+            row.append(' ' * left + text + ' ' * right)
+        self.emit('|' + '|'.join(row) + '|')
+
+    def emit(self, line):
+        if self.outfile is not None:
+            self.outfile.write(line + '\n')
+        if self.cmp_lines is not None:
+            if self.line_no >= len(self.cmp_lines):
+                raise Mismatch('line %d: no such line in the compare file' % (self.line_no + 1))
+            if not cells_match(line, self.cmp_lines[self.line_no]):
+                raise Mismatch('line %d: got %s expected %s' % (self.line_no + 1, line.strip(),
+                                                                 self.cmp_lines[self.line_no].strip()))
+        self.line_no += 1
+
+
+def run_script(f_name, build=True, max_cycles=10 ** 8, options=None):
+    # worker: run one script; returns (f_name, status, message, cycles, seconds)
+    start = time.perf_counter()
+    script = TestScript(f_name, build, max_cycles, options)
+    status, message = 'PASS', ''
+    try:
+        script.run()
+    except Mismatch as e:
+        status, message = 'FAIL', str(e)
+    except Unsupported as e:
+        status, message = 'SKIP', 'unsupported %s' % e
+    except Exception as e:
+        # any other error fails this script only, not the whole run
+        status, message = 'FAIL', '%s: %s' % (type(e).__name__, e)
+    cycles = script.emulator.cycles if script.emulator is not None else 0
+    return f_name, status, message, cycles, time.perf_counter() - start
+
+
+def collect(paths):
+    # .tst files in command-line order, directories searched recursively in sorted order
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            for root, dirs, names in os.walk(path):
+                dirs.sort()
+                files.extend(os.path.join(root, f) for f in sorted(names) if f.endswith('.tst'))
+        else:
+            files.append(path)
+    return files
+
+
+def main(argv):
+    ap = argparse.ArgumentParser(description='Run nand2tetris .tst scripts against .cmp files')
+    ap.add_argument('paths', nargs='+', help='.tst files or directories to search')
+    ap.add_argument('-j', '--workers', type=int, default=os.cpu_count(), help='worker processes')
+    ap.add_argument('--cycles', type=int, default=10 ** 8, help='cycle budget per script')
+    ap.add_argument('--no-build', dest='build', action='store_false',
+                    help='load .hack/.asm files as they are instead of rebuilding them')
+    for flag in ('fold', 'tos', 'peephole', 'shared'):
+        ap.add_argument('--' + flag, action='store_true')
+    ap.add_argument('--shared-arith', dest='shared_arithmetic', action='store_true')
+    ap.add_argument('--inline-calls', dest='inline_calls', action='store_true')
+    args = ap.parse_args(argv)
+    options = dict(fold=args.fold, tos=args.tos, peephole=args.peephole, shared=args.shared,
+                   shared_arithmetic=args.shared_arithmetic, inline_calls=args.inline_calls)
+    files = collect(args.paths)
+    if not files:
+        print('no .tst files found', file=sys.stderr)
+        return 1
+    start = time.perf_counter()
+    n = len(files)
+    with ProcessPoolExecutor(max_workers=args.workers) as pool:
+        results = list(pool.map(run_script, files, [args.build] * n, [args.cycles] * n, [options] * n))
+    totals = {'PASS': 0, 'FAIL': 0, 'SKIP': 0}
+    width = max(len(f) for f in files)
+    for f_name, status, message, cycles, seconds in results:
+        totals[status] += 1
+        print('%-4s %-*s %12d cycles %8.3fs  %s' % (status, width, f_name, cycles, seconds, message))
+    print('%d passed, %d failed, %d skipped in %.2fs'
+          % (totals['PASS'], totals['FAIL'], totals['SKIP'], time.perf_counter() - start))
+    return 1 if totals['FAIL'] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,15 @@
+# Checks for the assembler's encoding tables
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), '06'))
+from HackAssembler import Code, assemble
+
+
+def test_comp_table_matches_alu():
+    # every comp mnemonic's bits compute what the mnemonic says on the Hack ALU
+    assert Code.check() == []
+
+
+def test_word_table():
+    assert assemble('@21\nD=M\nAM=M+1;JMP\n') == [21, 0b1111110000010000, 0b1111110111101111]
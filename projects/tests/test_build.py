@@ -0,0 +1,25 @@
+# Checks for the batch build driver
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from HackBuild import build_file
+
+STATICS = 'push constant 7\npop static 0\npush static 0\n'
+
+
+def test_cache_is_keyed_by_file_name(tmp_path):
+    # byte-identical sources under different names have different statics
+    cache_dir = str(tmp_path / 'cache')
+    for name in ('Foo', 'Bar'):
+        f_name = str(tmp_path / (name + '.vm'))
+        with open(f_name, 'w') as outfile:
+            outfile.write(STATICS)
+        _, error, _, hit = build_file(f_name, cache_dir)
+        assert error is None and not hit
+        with open(str(tmp_path / (name + '.asm'))) as infile:
+            asm = infile.read()
+        assert '@%s.0' % name in asm
+    # and an unchanged file is still a hit
+    _, _, _, hit = build_file(str(tmp_path / 'Bar.vm'), cache_dir)
+    assert hit
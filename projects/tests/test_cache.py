@@ -0,0 +1,20 @@
+# Checks for the build cache
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from HackCache import BuildCache
+
+
+def test_clear_keeps_unrelated_files(tmp_path):
+    (tmp_path / 'keep.txt').write_text('not the cache\n')
+    cache = BuildCache(str(tmp_path))
+    out = tmp_path / 'out.hack'
+    out.write_text('0\n')
+    key = cache.key(b'source', 'tool')
+    cache.put(key, str(out))
+    cache.record(1, 0)
+    cache.clear()
+    assert (tmp_path / 'keep.txt').exists() and out.exists()
+    assert not os.path.exists(os.path.join(str(tmp_path), 'stats.json'))
+    assert cache.entries() == []
@@ -0,0 +1,43 @@
+# Checks for the emulator's forked runs
+import os
+import sys
+from array import array
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), '06'))
+from HackAssembler import assemble
+from HackEmulator import HackEmulator, fork_map
+
+
+class Unpicklable(Exception):
+    def __reduce__(self):
+        raise TypeError('cannot pickle')
+
+
+def run(emulator, item):
+    if item == 'result':
+        return lambda: None
+    if item == 'exception':
+        raise Unpicklable()
+    return item * 2
+
+
+def test_fork_map_unpicklable():
+    emulator = HackEmulator(array('H', [0]))
+    pid = os.getpid()
+    assert fork_map(emulator, run, [1, 2]) == [2, 4]
+    for item in ('result', 'exception'):
+        with pytest.raises(ChildProcessError, match='cannot pickle'):
+            fork_map(emulator, run, [item])
+        # a child that failed to send its result must not carry on as the caller
+        assert os.getpid() == pid
+
+
+def test_engines_honour_budget():
+    rom = array('H', assemble('@5\nD=A\n(LOOP)\n@R0\nM=M+1\nD=D-1\n@LOOP\nD;JGT\n(END)\n@END\n0;JMP\n'))
+    for budget in range(40):
+        interp, blocks = HackEmulator(rom), HackEmulator(rom)
+        assert interp.run(budget) == blocks.run_blocks(budget)
+        assert (interp.pc, interp.a, interp.d, interp.cycles, interp.halted, interp.ram[0]) == \
+            (blocks.pc, blocks.a, blocks.d, blocks.cycles, blocks.halted, blocks.ram[0])
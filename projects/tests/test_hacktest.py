@@ -0,0 +1,50 @@
+# Checks for the .tst script runner
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from HackTest import run_script
+
+PROGRAM = '''
+@258
+D=A
+@0
+M=D
+@256
+M=-1
+@5
+D=A
+@257
+M=D
+(END)
+@END
+0;JMP
+'''
+
+# each output-list writes its own header row, as in the course's StackTest.tst
+SCRIPT = '''
+load Two.asm,
+output-file Two.out,
+compare-to Two.cmp,
+output-list RAM[0]%D2.6.2;
+repeat 20 {
+  ticktock;
+}
+output;
+output-list RAM[256]%D2.6.2 RAM[257]%D2.6.2;
+output;
+'''
+
+COMPARE = '''|  RAM[0]  |
+|     258  |
+| RAM[256] | RAM[257] |
+|      -1  |       5  |
+'''
+
+
+def test_two_output_lists(tmp_path):
+    for name, text in (('Two.asm', PROGRAM), ('Two.tst', SCRIPT), ('Two.cmp', COMPARE)):
+        (tmp_path / name).write_text(text)
+    _, status, message, _, _ = run_script(str(tmp_path / 'Two.tst'))
+    assert (status, message) == ('PASS', '')
+    assert (tmp_path / 'Two.out').read_text() == COMPARE
@@ -0,0 +1,107 @@
+# Checks that the ROM optimizer does not change what a program computes
+import os
+import sys
+from array import array
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), '06'))
+from HackAssembler import assemble
+from HackEmulator import HackEmulator
+
+# loops to the numeric address 6 with a conditional jump; @R1 M=1 is unreachable
+NUMERIC_JUMP = '''
+@3
+D=A
+@SKIP
+0;JMP
+@R1
+M=1
+(SKIP)
+(LOOP)
+@R0
+M=M+1
+@6
+D=D-1;JGT
+(END)
+@END
+0;JMP
+'''
+
+# the same loop through an address stored in RAM and an indirect jump
+INDIRECT_JUMP = '''
+@3
+D=A
+@R3
+M=D
+@SKIP
+0;JMP
+@R1
+M=1
+(SKIP)
+@R0
+M=M+1
+@R3
+MD=M-1
+@END
+D;JEQ
+@8
+D=A
+@R2
+M=D
+@R2
+A=M
+0;JMP
+(END)
+@END
+0;JMP
+'''
+
+# labels only: the optimizer may remove the unreachable code and thread the jumps
+LABELS_ONLY = '''
+@3
+D=A
+@SKIP
+0;JMP
+@R1
+M=1
+(SKIP)
+@HOP
+0;JMP
+(HOP)
+@LOOP
+0;JMP
+(LOOP)
+@R0
+M=M+1
+@LOOP
+D=D-1;JGT
+(END)
+@END
+0;JMP
+'''
+
+
+def run(source, optimize_rom):
+    rom = assemble(source, optimize_rom=optimize_rom)
+    emulator = HackEmulator(array('H', rom))
+    emulator.run(10000)
+    assert emulator.halted
+    return rom, emulator.ram[:8].tolist()
+
+
+def test_numeric_jump():
+    _, plain = run(NUMERIC_JUMP, False)
+    _, optimized = run(NUMERIC_JUMP, True)
+    assert plain[0] == 3 and optimized == plain
+
+
+def test_indirect_numeric_jump():
+    _, plain = run(INDIRECT_JUMP, False)
+    _, optimized = run(INDIRECT_JUMP, True)
+    assert plain[0] == 3 and optimized == plain
+
+
+def test_labels_only():
+    rom, plain = run(LABELS_ONLY, False)
+    optimized_rom, optimized = run(LABELS_ONLY, True)
+    assert plain[0] == 3 and optimized == plain
+    assert len(optimized_rom) < len(rom)
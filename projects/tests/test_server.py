@@ -0,0 +1,54 @@
+# Checks for the assembler/translator daemon's request handling
+import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+from HackClient import HackClient, HackServerError
+from HackServer import handle
+
+
+def test_options_are_checked_per_op():
+    assert handle('assemble', b'@1\n', {'binary': True}) == b'\x01\x00'
+    with pytest.raises(ValueError, match='options not valid for assemble: tos'):
+        handle('assemble', b'@1\n', {'tos': True})
+    with pytest.raises(ValueError, match='options not valid for translate: binary'):
+        handle('translate', b'push constant 1\n', {'binary': True})
+    with pytest.raises(ValueError, match='unknown op'):
+        handle('link', b'', {})
+
+
+@pytest.fixture
+def server():
+    socket_path = os.path.join(tempfile.mkdtemp(), 's')
+    proc = subprocess.Popen([sys.executable, os.path.join(ROOT, 'HackServer.py'), '--socket', socket_path, '-j', '1'],
+                            stderr=subprocess.DEVNULL)
+    for _ in range(200):
+        if os.path.exists(socket_path):
+            break
+        time.sleep(0.05)
+    yield socket_path
+    proc.terminate()
+    proc.wait()
+
+
+def test_bad_requests(server):
+    with HackClient(server) as client:
+        client.sock.sendall(json.dumps({'length': 3}).encode() + b'\n@1\n')
+        assert json.loads(client.infile.readline()) == {'ok': False, 'error': 'ValueError: request has no op'}
+        with pytest.raises(HackServerError, match='options not valid for assemble: fold'):
+            client.request('assemble', '@1\n', fold=True)
+        # the connection is still in step after the errors
+        assert client.request('assemble', '@1\n') == b'0000000000000001\n'
+    with HackClient(server) as client:
+        client.sock.sendall(json.dumps({'op': 'assemble'}).encode() + b'\n@1\n')
+        reply = json.loads(client.infile.readline())
+        assert reply == {'ok': False, 'error': 'bad request header: no valid length'}
+        assert client.infile.readline() == b''
@@ -0,0 +1,193 @@
+# Checks that the translator's optional rewrites do not change what a program computes:
+# each program is translated with and without them, run on HackEmulator and the RAM
+# compared, except the stack and the R13-R15 scratch registers
+import io
+import os
+import sys
+from array import array
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, '06'))
+sys.path.insert(0, os.path.join(ROOT, '07'))
+from HackAssembler import assemble
+from HackEmulator import HackEmulator
+from VMTranslator import translate_files
+
+# a loop, every arithmetic command and every segment; run with the test scripts' pointers
+ARITHMETIC = {'Main.vm': '''
+push constant 10
+pop local 0
+push constant 0
+pop local 1
+label LOOP
+push local 1
+push local 0
+add
+pop local 1
+push local 0
+push constant 1
+sub
+pop local 0
+push local 0
+push constant 0
+gt
+if-goto LOOP
+push constant 3
+push constant 4
+add
+push constant 2
+sub
+neg
+pop static 0
+push local 1
+push constant 55
+eq
+pop static 1
+push constant 7
+push constant 9
+lt
+push constant 12
+push constant 10
+and
+or
+not
+pop static 2
+push argument 0
+push argument 1
+sub
+pop temp 3
+push temp 3
+pop this 1
+push constant 3020
+pop pointer 1
+push static 0
+pop that 2
+push argument 1
+push argument 0
+gt
+push argument 0
+push argument 1
+eq
+or
+pop local 2
+'''}
+ARITHMETIC_RAM = {0: 256, 1: 300, 2: 400, 3: 3000, 4: 3010, 400: 21, 401: -4}
+
+# recursion, loops and several argument counts, started by the bootstrap code
+CALLS = {'Sys.vm': '''
+function Sys.init 0
+push constant 6
+call Main.fib 1
+pop static 0
+push constant 3
+push constant 4
+call Main.mul 2
+pop static 1
+push constant 5
+push constant 9
+call Main.max 2
+pop static 2
+label HALT
+goto HALT
+''', 'Main.vm': '''
+function Main.fib 0
+push argument 0
+push constant 2
+lt
+if-goto BASE
+push argument 0
+push constant 1
+sub
+call Main.fib 1
+push argument 0
+push constant 2
+sub
+call Main.fib 1
+add
+return
+label BASE
+push argument 0
+return
+function Main.mul 2
+push argument 1
+pop local 1
+label LOOP
+push local 1
+push constant 0
+eq
+if-goto DONE
+push local 0
+push argument 0
+add
+pop local 0
+push local 1
+push constant 1
+sub
+pop local 1
+goto LOOP
+label DONE
+push local 0
+return
+function Main.max 0
+push argument 0
+push argument 1
+gt
+if-goto FIRST
+push argument 1
+return
+label FIRST
+push argument 0
+return
+'''}
+
+
+def run(tmp_path, files, ram=None, optimize_rom=False, **options):
+    # RAM after running files translated with options, with scratch and stack cleared
+    names = []
+    for name, text in files.items():
+        (tmp_path / name).write_text(text)
+        names.append(str(tmp_path / name))
+    out = io.StringIO()
+    translate_files(sorted(names), str(tmp_path / 'Prog'), out, bootstrap='Sys.vm' in files, **options)
+    emulator = HackEmulator(array('H', assemble(out.getvalue(), optimize_rom=optimize_rom)))
+    for addr, value in (ram or {}).items():
+        emulator.ram[addr] = value
+    emulator.run(10 ** 6)
+    assert emulator.halted
+    ram = emulator.ram.tolist()
+    ram[13:16] = [0] * 3
+    ram[256:300] = [0] * 44
+    return ram
+
+
+def check(tmp_path, optimize_rom=False, **options):
+    expected = run(tmp_path, ARITHMETIC, ARITHMETIC_RAM)
+    assert expected[16:19] == [-5, -1, 0] and expected[301] == 55
+    assert run(tmp_path, ARITHMETIC, ARITHMETIC_RAM, optimize_rom, **options) == expected
+    expected = run(tmp_path, CALLS)
+    assert expected[16:19] == [8, 12, 9]
+    assert run(tmp_path, CALLS, None, optimize_rom, **options) == expected
+
+
+def test_peephole(tmp_path):
+    check(tmp_path, peephole=True)
+
+
+def test_shared_routines(tmp_path):
+    check(tmp_path, shared=True)
+    check(tmp_path, shared_arithmetic=True)
+    check(tmp_path, shared=True, shared_arithmetic=True, inline_calls=True)
+
+
+def test_fold(tmp_path):
+    check(tmp_path, fold=True)
+
+
+def test_tos(tmp_path):
+    check(tmp_path, tos=True)
+    check(tmp_path, tos=True, fold=True, peephole=True, shared=True, shared_arithmetic=True)
+
+
+def test_rom_optimizer(tmp_path):
+    check(tmp_path, optimize_rom=True)
+    check(tmp_path, optimize_rom=True, tos=True, fold=True, peephole=True, shared=True, shared_arithmetic=True)